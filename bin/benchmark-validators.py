@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Measures the time needed to validate acquire URLs, both for valid URLs and
+for pathological inputs (long hostnames, many labels, long IPv6-like hosts)
+that make the regular expression backtrack. It must be run in an
+environment where CKAN and the extension are installed.
+
+Usage:
+
+    python bin/benchmark-validators.py --repeat 1000
+'''
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import timeit
+
+from ckanext.privatedatasets.converters_validators import URL_MAX_LENGTH, URL_REGEX, is_valid_url
+
+
+INPUTS = [
+    ('valid', 'https://example.com:443/path/to/resource?a=b&c=d'),
+    ('valid long path', 'https://example.com/' + 'a' * 2000),
+    ('many labels', 'http://' + 'a.' * 1000 + '!'),
+    ('long labels', 'http://' + ('a' * 61 + '.') * 32 + '!'),
+    ('long label', 'http://' + 'a' * 2000 + '!'),
+    ('ipv6-like host', 'http://[' + '1:' * 1000 + '!'),
+    ('too long', 'http://' + 'a.' * 50000 + '!'),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the acquire URL validator')
+    parser.add_argument('--repeat', type=int, default=1000, help='Validations of each input')
+    args = parser.parse_args()
+
+    print('%-16s %8s %8s %14s %14s' % ('input', 'length', 'valid', 'validator (us)', 'regex (us)'))
+    for name, url in INPUTS:
+        validator = timeit.timeit(lambda: is_valid_url(url), number=args.repeat) / args.repeat
+        # The regular expression without the length limit, to show the cost it avoids
+        regex = timeit.timeit(lambda: URL_REGEX.match(url), number=args.repeat) / args.repeat
+        print('%-16s %8d %8s %14.1f %14.1f' % (name, len(url), is_valid_url(url), validator * 1e6, regex * 1e6))
+
+    print('URLs longer than %d characters are rejected without evaluating the regular expression' % URL_MAX_LENGTH)
+
+
+if __name__ == '__main__':
+    main()
@@ -47,4 +47,7 @@ cd -
 echo "Installing ckanext-privatedatasets and its requirements..."
 python setup.py develop
 
+echo "Initialising the ckanext-privatedatasets tables..."
+paster --plugin=ckanext-privatedatasets privatedatasets initdb -c test.ini
+
 echo "travis-build.bash is done."
\ No newline at end of file
@@ -20,18 +20,28 @@
 
 from __future__ import absolute_import
 
+import collections
 import importlib
 import logging
 import os
 
 import ckan.plugins as plugins
+import sqlalchemy as sa
 
-from ckanext.privatedatasets import constants, db
+from ckanext.privatedatasets import cache, constants, db, helpers, indexing
 
 
 log = logging.getLogger(__name__)
 
 PARSER_CONFIG_PROP = 'ckan.privatedatasets.parser'
+USE_PACKAGE_UPDATE_CONFIG_PROP = 'ckan.privatedatasets.use_package_update'
+SKIP_UNKNOWN_USERS_CONFIG_PROP = 'ckan.privatedatasets.skip_unknown_users'
+
+# Solr limits the number of clauses of a query
+SEARCH_MAX_IDS = 500
+
+# The notification parser is loaded once (see load_parser)
+_parser = None
 
 
 def package_acquired(context, request_data):
@@ -70,6 +80,13 @@ def acquisitions_list(context, data_dict):
         of the user that is performing the request
     :type user: string
 
+    :parameter limit: The maximum number of datasets to return. This parameter is optional.
+        If you don't include it, all the acquired datasets will be returned
+    :type limit: int
+
+    :parameter offset: The number of datasets to skip. This parameter is optional (default: 0)
+    :type offset: int
+
     :return: The list of datarequest that has been acquired by the specified user
     :rtype: list
     '''
@@ -82,40 +99,70 @@ def acquisitions_list(context, data_dict):
 
     plugins.toolkit.check_access(constants.ACQUISITIONS_LIST, context.copy(), data_dict)
 
-    # Init db
-    db.init_db(context['model'])
-
-    # Init the result array
-    result = []
-
     # Check that the user exists
     try:
         plugins.toolkit.get_validator('user_name_exists')(data_dict['user'], context.copy())
     except Exception:
         raise plugins.toolkit.ValidationError('User %s does not exist' % data_dict['user'])
 
-    # Get the datasets acquired by the user
-    query = db.AllowedUser.get(user_name=data_dict['user'])
+    limit = _get_natural_number(data_dict, 'limit', None)
+    offset = _get_natural_number(data_dict, 'offset', 0)
 
-    # Get the datasets
-    for dataset in query:
-        try:
-            dataset_show_func = 'package_show'
-            func_data_dict = {'id': dataset.package_id}
-            internal_context = context.copy()
+    # Get the active datasets acquired by the user. Since acquired datasets are always
+    # readable by the user, there is no need to check the access to each one
+    package_ids = db.AllowedUser.get_acquired_package_ids(data_dict['user'], limit, offset)
 
-            # Check that the the dataset can be accessed and get its data
-            # FIX: If the check_access function is not called, an exception is risen.
-            plugins.toolkit.check_access(dataset_show_func, internal_context, func_data_dict)
-            dataset_dict = plugins.toolkit.get_action(dataset_show_func)(internal_context, func_data_dict)
+    return _search_packages(context, package_ids)
 
-            # Only packages with state == 'active' can be shown
-            if dataset_dict.get('state', None) == 'active':
-                result.append(dataset_dict)
-        except Exception:
-            pass
 
-    return result
+def _get_natural_number(data_dict, field, default):
+    value = data_dict.get(field)
+
+    if value is None:
+        return default
+
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = -1
+
+    if value < 0:
+        raise plugins.toolkit.ValidationError({field: ['Must be a natural number']})
+
+    return value
+
+
+def _search_packages(context, package_ids):
+    # Datasets are retrieved from the search index instead of calling package_show
+    # for each one. The order of the given list is kept. Datasets that are not
+    # returned by the search (e.g. the index has not been updated yet) are
+    # retrieved with package_show
+    search_context = context.copy()
+    search_context['ignore_auth'] = True
+    package_search = plugins.toolkit.get_action('package_search')
+
+    packages = {}
+    for i in range(0, len(package_ids), SEARCH_MAX_IDS):
+        ids = package_ids[i:i + SEARCH_MAX_IDS]
+        search_result = package_search(search_context, {
+            'fq': 'id:(%s)' % ' OR '.join('"%s"' % package_id for package_id in ids),
+            'rows': len(ids),
+            'include_private': True
+        })
+
+        for package in search_result['results']:
+            packages[package['id']] = package
+
+    package_show = plugins.toolkit.get_action('package_show')
+    for package_id in package_ids:
+        if package_id not in packages:
+            try:
+                packages[package_id] = package_show(search_context.copy(), {'id': package_id})
+            except plugins.toolkit.ObjectNotFound:
+                # The dataset has been purged after getting the list of IDs
+                pass
+
+    return [packages[package_id] for package_id in package_ids if package_id in packages]
 
 
 def revoke_access(context, request_data):
@@ -145,15 +192,91 @@ def revoke_access(context, request_data):
     return _process_package(context, request_data)
 
 
-def _process_package(context, request_data):
-    log.info('Notification received: %s' % request_data)
+def purge_access(context, data_dict):
+    '''
+    API action to remove all the access grants of several datasets at once (e.g.
+    when an organization is going to be removed). The search index of the
+    modified datasets is updated. Only sysadmins can call it.
 
-    # Check access
-    method = constants.PACKAGE_ACQUIRED if context.get('method') == 'grant' else constants.PACKAGE_DELETED
-    plugins.toolkit.check_access(method, context, request_data)
+    :parameter packages: The IDs or names of the datasets
+    :type packages: list
 
-    # Get the parser from the configuration
-    class_path = os.environ.get(PARSER_CONFIG_PROP.upper().replace('.', '_'), plugins.toolkit.config.get(PARSER_CONFIG_PROP, ''))
+    :parameter organization: The ID or name of an organization. The grants of
+        all its datasets are removed. Ignored if packages is given.
+    :type organization: string
+
+    :return: The IDs of the datasets whose grants have been removed
+    :rtype: dict
+    '''
+    plugins.toolkit.check_access(constants.PURGE_ACCESS, context.copy(), data_dict)
+
+    model = context['model']
+
+    if data_dict.get('packages') is not None:
+        packages = data_dict['packages']
+        if not isinstance(packages, list) or not packages:
+            raise plugins.toolkit.ValidationError({'packages': ['Must be a non empty list']})
+
+        query = model.Session.query(model.Package.id).filter(
+            sa.or_(model.Package.id.in_(packages), model.Package.name.in_(packages)))
+    elif data_dict.get('organization'):
+        organization = model.Group.get(data_dict['organization'])
+        if organization is None or not organization.is_organization:
+            raise plugins.toolkit.ObjectNotFound('Organization %s not found' % data_dict['organization'])
+
+        query = model.Session.query(model.Package.id).filter(model.Package.owner_org == organization.id)
+    else:
+        raise plugins.toolkit.ValidationError({'message': 'packages or organization must be provided'})
+
+    package_ids = [package_id for (package_id,) in query]
+
+    purged = db.AllowedUser.delete_by_packages(package_ids)
+    model.Session.commit()
+
+    purged = [package_id for package_id in package_ids if package_id in purged]
+    for package_id in purged:
+        cache.invalidate_package(package_id)
+    indexing.update_index(purged)
+
+    return {'packages': purged}
+
+
+def index_queue_stats(context, data_dict):
+    '''
+    API action that returns the metrics of the queue used to update the search
+    index in the background. Each CKAN process has its own queue, so the
+    metrics refer to the process serving the request. Only sysadmins can call
+    it.
+
+    :return: Whether asynchronous updates are enabled (`enabled`), the number
+        of pending packages (`depth`), the seconds the oldest one has been
+        waiting (`lag`) and the number of packages in the spool file (`spooled`)
+    :rtype: dict
+    '''
+    plugins.toolkit.check_access(constants.INDEX_QUEUE_STATS, context.copy(), data_dict)
+
+    stats = indexing.get_queue().stats()
+    stats['enabled'] = helpers.get_config_bool_value(indexing.ASYNC_UPDATE_CONFIG_PROP)
+
+    return stats
+
+
+def load_parser(config):
+    '''
+    Loads the notification parser set in the configuration. The parser is
+    reused for all the notifications, so this function is called when the
+    plugin is loaded in order to detect configuration errors on startup.
+
+    :parameter config: The CKAN configuration
+    :type config: dict
+
+    :return: The parser or None if no parser has been configured
+    :rtype: object
+    '''
+    global _parser
+
+    _parser = None
+    class_path = os.environ.get(PARSER_CONFIG_PROP.upper().replace('.', '_'), config.get(PARSER_CONFIG_PROP, ''))
 
     if class_path != '':
         try:
@@ -161,10 +284,24 @@ def _process_package(context, request_data):
             class_package = cls[0]
             class_name = cls[1]
             parser_cls = getattr(importlib.import_module(class_package), class_name)
-            parser = parser_cls()
+            _parser = parser_cls()
         except Exception as e:
             raise plugins.toolkit.ValidationError({'message': '%s: %s' % (type(e).__name__, str(e))})
-    else:
+
+    return _parser
+
+
+def _process_package(context, request_data):
+    log.info('Notification received: %s' % request_data)
+
+    # Check access
+    method = constants.PACKAGE_ACQUIRED if context.get('method') == 'grant' else constants.PACKAGE_DELETED
+    plugins.toolkit.check_access(method, context, request_data)
+
+    # Get the parser from the configuration
+    parser = _parser if _parser is not None else load_parser(plugins.toolkit.config)
+
+    if parser is None:
         raise plugins.toolkit.ValidationError({'message': '%s not configured' % PARSER_CONFIG_PROP})
 
     # Parse the result using the parser set in the configuration
@@ -172,68 +309,232 @@ def _process_package(context, request_data):
     #                   'users_datasets': [{'user': 'user_name', 'datasets': ['ds1', 'ds2', ...]}, ...]}
     result = parser.parse_notification(request_data)
 
+    users_datasets = result['users_datasets']
     warns = []
 
-    for user_info in result['users_datasets']:
-        for dataset_id in user_info['datasets']:
+    # Users that do not exist yet (e.g. they have not logged in CKAN) are
+    # reported, but they are only skipped if it is enabled in the configuration
+    if context.get('method') == 'grant':
+        skip_unknown = helpers.get_config_bool_value(SKIP_UNKNOWN_USERS_CONFIG_PROP)
+        users_datasets, warns = _check_users(context['model'], users_datasets, skip_unknown)
 
-            try:
-                context_pkg_show = context.copy()
-                context_pkg_show['ignore_auth'] = True
-                context_pkg_show[constants.CONTEXT_CALLBACK] = True
-                dataset = plugins.toolkit.get_action('package_show')(context_pkg_show, {'id': dataset_id})
-
-                # This operation can only be performed with private datasets
-                # This check is redundant since the package_update function will throw an exception
-                # if a list of allowed users is included in a public dataset. However, this check
-                # should be performed in order to avoid strange future exceptions
-                if dataset.get('private', None) is True:
-
-                    # Create the array if it does not exist
-                    if constants.ALLOWED_USERS not in dataset or dataset[constants.ALLOWED_USERS] is None:
-                        dataset[constants.ALLOWED_USERS] = []
-
-                    method = context['method'] == 'grant'
-                    present = user_info['user'] in dataset[constants.ALLOWED_USERS]
-                    # Deletes the user only if it is in the list
-                    if (not method and present) or (method and not present):
-                        if method:
-                            dataset[constants.ALLOWED_USERS].append(user_info['user'])
-                        else:
-                            dataset[constants.ALLOWED_USERS].remove(user_info['user'])
+    if helpers.get_config_bool_value(USE_PACKAGE_UPDATE_CONFIG_PROP):
+        warns += _update_packages(context, users_datasets)
+    else:
+        warns += _update_allowed_users(context, users_datasets)
 
-                        context_pkg_update = context.copy()
-                        context_pkg_update['ignore_auth'] = True
+    # Return warnings that inform about non-existing datasets
+    if len(warns) > 0:
+        return {'warns': warns}
 
-                        # Set creator as the user who is performing the changes
-                        user_show = plugins.toolkit.get_action('user_show')
-                        creator_user_id = dataset.get('creator_user_id', '')
-                        user_show_context = {'ignore_auth': True}
-                        user = user_show(user_show_context, {'id': creator_user_id})
-                        context_pkg_update['user'] = user.get('name', '')
 
-                        plugins.toolkit.get_action('package_update')(context_pkg_update, dataset)
-                        log.info('Action %s access to dataset ended successfully' % context['method'])
-                    else:
-                        log.warn('Action %s access to dataset not completed. The dataset %s already %s access to the user %s' % (context['method'], dataset_id, context['method'], user_info['user']))
-                else:
-                    log.warn('Dataset %s is public. Cannot %s access to users' % (dataset_id, context['method']))
-                    warns.append('Unable to upload the dataset %s: It\'s a public dataset' % dataset_id)
+def _check_users(model, users_datasets, skip_unknown):
+    # All the users of the notification are validated with a single query.
+    # Entries of non existing users are discarded when skip_unknown is set.
+    user_names = list(set(user_info['user'] for user_info in users_datasets))
+    existing = set()
+    if user_names:
+        query = model.Session.query(model.User.name).filter(model.User.name.in_(user_names))
+        existing = set(user_name for (user_name,) in query)
 
-            except plugins.toolkit.ObjectNotFound:
+    valid = []
+    warns = []
+    for user_info in users_datasets:
+        if user_info['user'] not in existing:
+            log.warn('User %s was not found in this instance' % user_info['user'])
+            warns.append('User %s was not found in this instance' % user_info['user'])
+            if skip_unknown:
+                continue
+
+        valid.append(user_info)
+
+    return valid, warns
+
+
+def _resolve_packages(model, references):
+    # Maps the IDs and names of the given datasets to their ID, private flag and
+    # state using a single query. Unknown datasets are not included.
+    references = list(set(references))
+    if not references:
+        return {}
+
+    query = model.Session.query(model.Package.id, model.Package.name, model.Package.private, model.Package.state).filter(
+        sa.or_(model.Package.id.in_(references), model.Package.name.in_(references)))
+
+    packages = {}
+    for package in query:
+        packages[package.id] = package
+        packages[package.name] = package
+
+    return packages
+
+
+def _update_allowed_users(context, users_datasets):
+    # Grants are stored directly in the allowed users table using a single
+    # statement for all of them and only the search index of the modified
+    # datasets is updated
+    model = context['model']
+    grant = context['method'] == 'grant'
+
+    warns = []
+    pairs = []
+    processed = set()
+
+    # All the datasets of the notification are retrieved at once
+    packages = _resolve_packages(model, [dataset_id for user_info in users_datasets for dataset_id in user_info['datasets']])
+
+    for user_info in users_datasets:
+        user_name = user_info['user']
+
+        for dataset_id in user_info['datasets']:
+            package = packages.get(dataset_id)
+
+            if package is None or package.state == model.State.DELETED:
                 # If a dataset does not exist in the instance, an error message will be returned to the user.
                 # However the process won't stop and the process will continue with the remaining datasets.
                 log.warn('Dataset %s was not found in this instance' % dataset_id)
                 warns.append('Dataset %s was not found in this instance' % dataset_id)
-            except plugins.toolkit.ValidationError as e:
-                # Some datasets does not allow to introduce the list of allowed users since this property is
-                # only valid for private datasets outside an organization. In this case, a wanr will return
-                # but the process will continue
-                # WARN: This exception should not be risen anymore since public datasets are not updated.
-                message = '%s(%s): %s' % (dataset_id, constants.ALLOWED_USERS, e.error_dict[constants.ALLOWED_USERS][0])
-                log.warn(message)
-                warns.append(message)
+                continue
+
+            # This operation can only be performed with private datasets
+            if not package.private:
+                log.warn('Dataset %s is public. Cannot %s access to users' % (dataset_id, context['method']))
+                warns.append('Unable to upload the dataset %s: It\'s a public dataset' % dataset_id)
+                continue
+
+            # The same dataset can be included several times in the notification
+            if (package.id, user_name) not in processed:
+                processed.add((package.id, user_name))
+                pairs.append((package.id, user_name))
+
+    # Rows are inserted or deleted without reading them first, so concurrent
+    # notifications cannot overwrite each other. Users already in the list
+    # are not inserted again and users not in the list are not deleted
+    if grant:
+        changes = db.AllowedUser.add_all(pairs)
+    else:
+        changes = db.AllowedUser.delete_all(pairs)
 
-    # Return warnings that inform about non-existing datasets
-    if len(warns) > 0:
-        return {'warns': warns}
+    model.Session.commit()
+
+    updated_packages = []
+    for package_id, user_name in pairs:
+        if (package_id, user_name) not in changes:
+            log.warn('Action %s access to dataset not completed. The dataset %s already %s access to the user %s' % (context['method'], package_id, context['method'], user_name))
+        elif package_id not in updated_packages:
+            updated_packages.append(package_id)
+
+    # Grants cached during this request are not valid anymore
+    for package_id in updated_packages:
+        cache.invalidate_package(package_id)
+
+    indexing.update_index(updated_packages)
+    log.info('Action %s access to %d datasets ended successfully' % (context['method'], len(updated_packages)))
+
+    return warns
+
+
+def _group_by_dataset(users_datasets):
+    # dataset_id -> list of users, keeping the order of the notification
+    datasets_users = collections.OrderedDict()
+
+    for user_info in users_datasets:
+        for dataset_id in user_info['datasets']:
+            datasets_users.setdefault(dataset_id, []).append(user_info['user'])
+
+    return datasets_users
+
+
+def _get_user_name(model, user_id):
+    # The name is read from the model, the user_show action is too expensive
+    # since it dictizes the whole user
+    user = model.User.get(user_id) if user_id else None
+    return user.name if user is not None else ''
+
+
+def _lock_package(model, reference):
+    # The row of the dataset is locked until the end of the transaction, so
+    # concurrent notifications cannot read its allowed users until it is updated
+    query = model.Session.query(model.Package.id).filter(
+        sa.or_(model.Package.id == reference, model.Package.name == reference))
+    query.with_for_update().all()
+
+
+def _update_packages(context, users_datasets):
+    # Compatibility mode: allowed users are modified by updating the whole dataset.
+    # Users are grouped by dataset so each dataset is retrieved and updated only once
+    model = context['model']
+    warns = []
+    grant = context['method'] == 'grant'
+    # creator_user_id -> user name, most of the datasets share the same creator
+    creator_names = {}
+
+    for dataset_id, user_names in _group_by_dataset(users_datasets).items():
+
+        try:
+            _lock_package(model, dataset_id)
+
+            context_pkg_show = context.copy()
+            context_pkg_show['ignore_auth'] = True
+            context_pkg_show[constants.CONTEXT_CALLBACK] = True
+            dataset = plugins.toolkit.get_action('package_show')(context_pkg_show, {'id': dataset_id})
+
+            # This operation can only be performed with private datasets
+            # This check is redundant since the package_update function will throw an exception
+            # if a list of allowed users is included in a public dataset. However, this check
+            # should be performed in order to avoid strange future exceptions
+            if dataset.get('private', None) is True:
+
+                # Create the array if it does not exist
+                if constants.ALLOWED_USERS not in dataset or dataset[constants.ALLOWED_USERS] is None:
+                    dataset[constants.ALLOWED_USERS] = []
+
+                allowed_users = dataset[constants.ALLOWED_USERS]
+                modified = False
+
+                for user_name in user_names:
+                    present = user_name in allowed_users
+                    # Deletes the user only if it is in the list
+                    if (not grant and present) or (grant and not present):
+                        if grant:
+                            allowed_users.append(user_name)
+                        else:
+                            allowed_users.remove(user_name)
+                        modified = True
+                    else:
+                        log.warn('Action %s access to dataset not completed. The dataset %s already %s access to the user %s' % (context['method'], dataset_id, context['method'], user_name))
+
+                if modified:
+                    context_pkg_update = context.copy()
+                    context_pkg_update['ignore_auth'] = True
+
+                    # Set creator as the user who is performing the changes
+                    creator_user_id = dataset.get('creator_user_id', '')
+                    if creator_user_id not in creator_names:
+                        creator_names[creator_user_id] = _get_user_name(model, creator_user_id)
+                    context_pkg_update['user'] = creator_names[creator_user_id]
+
+                    plugins.toolkit.get_action('package_update')(context_pkg_update, dataset)
+                    log.info('Action %s access to dataset ended successfully' % context['method'])
+            else:
+                log.warn('Dataset %s is public. Cannot %s access to users' % (dataset_id, context['method']))
+                warns.extend(['Unable to upload the dataset %s: It\'s a public dataset' % dataset_id] * len(user_names))
+
+        except plugins.toolkit.ObjectNotFound:
+            # If a dataset does not exist in the instance, an error message will be returned to the user.
+            # However the process won't stop and the process will continue with the remaining datasets.
+            log.warn('Dataset %s was not found in this instance' % dataset_id)
+            warns.extend(['Dataset %s was not found in this instance' % dataset_id] * len(user_names))
+        except plugins.toolkit.ValidationError as e:
+            # Some datasets does not allow to introduce the list of allowed users since this property is
+            # only valid for private datasets outside an organization. In this case, a wanr will return
+            # but the process will continue
+            # WARN: This exception should not be risen anymore since public datasets are not updated.
+            message = '%s(%s): %s' % (dataset_id, constants.ALLOWED_USERS, e.error_dict[constants.ALLOWED_USERS][0])
+            log.warn(message)
+            warns.append(message)
+
+        # Release the lock when the dataset has not been updated
+        model.Session.commit()
+
+    return warns
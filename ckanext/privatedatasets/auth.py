@@ -25,7 +25,10 @@ import ckan.lib.helpers as helpers
 import ckan.logic.auth as logic_auth
 import ckan.plugins.toolkit as tk
 
-from ckanext.privatedatasets import db
+from ckanext.privatedatasets import cache, constants, db
+
+
+RESOURCES_CACHE = 'resources_read'
 
 
 @tk.auth_allow_anonymous_access
@@ -50,12 +53,7 @@ def package_show(context, data_dict):
                     package.owner_org, user, 'read')
 
             if not acquired:
-                # Init the model
-                db.init_db(context['model'])
-
-                # Branch not executed if the database return an empty list
-                if db.AllowedUser.get(package_id=package.id, user_name=user):
-                    acquired = True
+                acquired = db.is_allowed(package.id, user)
 
             if not acquired:
 
@@ -102,47 +100,142 @@ def package_update(context, data_dict):
 def resource_show(context, data_dict):
 
     user = context.get('user')
-    user_obj = context.get('auth_user_obj')
     resource = logic_auth.get_resource_object(context, data_dict)
-    # check authentication against package
-    package_dict = {'id': resource.package_id}
-    package = logic_auth.get_package_object(context, package_dict)
-    if not package:
-        raise tk.ObjectNotFound(_('No package found for this resource, cannot check auth.'))
 
-    if package and user_obj and package.creator_user_id == user_obj.id:
+    # check authentication against package
+    if can_read_resources(context, resource.package_id):
         return {'success': True}
+    else:
+        return {'success': False, 'msg': _('User %s not authorized to read resource %s') % (user, resource.id)}
+
+
+def _can_read_resources(context, package):
+    user = context.get('user')
+    user_obj = context.get('auth_user_obj')
+
+    if user_obj and package.creator_user_id == user_obj.id:
+        return True
 
     # active packages can only be seen by its owners
-    if package.state == 'active':
+    if package.state != 'active':
+        return False
 
-        # anyone can see a public package
-        if not package.private:
-            return {'success': True}
+    # anyone can see a public package
+    if not package.private:
+        return True
 
-        # if the user has rights to read in the organization or in the group
-        if package.owner_org:
-            authorized = authz.has_user_permission_for_group_or_org(
-                package.owner_org, user, 'read')
-        else:
-            authorized = False
+    # if the user has rights to read in the organization or in the group
+    if package.owner_org and authz.has_user_permission_for_group_or_org(package.owner_org, user, 'read'):
+        return True
+
+    return db.is_allowed(package.id, user)
+
+
+def can_read_resources(context, package_id):
+    '''
+    Checks whether the user can read the resources of a package. The decision
+    only depends on the package, so it is cached until the end of the request
+    and reused for all its resources.
+
+    :param package_id: The ID of the package
+    :type package_id: string
+
+    :raises ObjectNotFound: if the package does not exist
+
+    :returns: True if the user can read the resources of the package
+    :rtype: bool
+    '''
+    user = context.get('user')
+    decisions = cache.get_request_cache(RESOURCES_CACHE).setdefault(package_id, {})
+
+    if user not in decisions:
+        package = logic_auth.get_package_object(context, {'id': package_id})
+        if not package:
+            raise tk.ObjectNotFound(_('No package found for this resource, cannot check auth.'))
+
+        decisions[user] = _can_read_resources(context, package)
+
+    return decisions[user]
+
+
+def can_see_allowed_users(context, private, creator_user_id):
+    '''
+    Checks whether the list of allowed users (and the searchable field) of a
+    dataset can be returned. These fields can be only viewed by (and only if
+    the dataset is private):
+    * the dataset creator
+    * the sysadmin
+    * users allowed to update the allowed_users list via the notification API
+
+    :param private: The private field of the dataset
+    :type private: bool
+
+    :param creator_user_id: The ID of the user who created the dataset
+    :type creator_user_id: string
+
+    :rtype: bool
+    '''
+    if private is False:
+        return False
+
+    if context.get(constants.CONTEXT_CALLBACK, False):
+        return True
+
+    user_obj = context.get('auth_user_obj')
+    return bool(user_obj and (creator_user_id == user_obj.id or user_obj.sysadmin))
 
-        if not authorized:
-            # Init the model
-            db.init_db(context['model'])
 
-            # Branch not executed if the database return an empty list
-            if db.AllowedUser.get(package_id=package.id, user_name=user):
-                authorized = True
+def get_readable_packages(context, packages):
+    '''
+    Bulk version of the checks performed by resource_show. Grants are retrieved
+    with a single query and organization permissions are checked once per
+    organization, so it is suitable for search results.
 
-        if not authorized:
-            return {'success': False, 'msg': _('User %s not authorized to read resource %s') % (user, resource.id)}
+    :param packages: The packages to check (as dicts)
+    :type packages: list
 
+    :returns: The IDs of the packages whose resources can be read by the user
+    :rtype: set
+    '''
+    user = context.get('user')
+    user_obj = context.get('auth_user_obj')
+
+    # Sysadmins can read everything
+    if user_obj and user_obj.sysadmin:
+        return set(package['id'] for package in packages)
+
+    readable = set()
+    private_packages = []
+
+    for package in packages:
+        if user_obj and package.get('creator_user_id') == user_obj.id:
+            readable.add(package['id'])
+        elif package.get('state') == 'active':
+            # anyone can see a public package
+            if package.get('private'):
+                private_packages.append(package)
+            else:
+                readable.add(package['id'])
+
+    # if the user has rights to read in the organization or in the group
+    orgs_permissions = {}
+    not_authorized = []
+    for package in private_packages:
+        owner_org = package.get('owner_org')
+        if owner_org and owner_org not in orgs_permissions:
+            orgs_permissions[owner_org] = authz.has_user_permission_for_group_or_org(
+                owner_org, user, 'read')
+
+        if owner_org and orgs_permissions[owner_org]:
+            readable.add(package['id'])
         else:
-            return {'success': True}
+            not_authorized.append(package['id'])
+
+    if not_authorized:
+        readable.update(db.get_allowed_packages(not_authorized, user))
+
+    return readable
 
-    else:
-        return {'success': False, 'msg': _('User %s not authorized to read resource %s') % (user, resource.id)}
 
 @tk.auth_allow_anonymous_access
 def package_acquired(context, data_dict):
@@ -159,3 +252,13 @@ def acquisitions_list(context, data_dict):
 def revoke_access(context, data_dict):
     # TODO: Check functionality and improve security(if needed)
     return {'success': True}
+
+
+def purge_access(context, data_dict):
+    # Only sysadmins can purge grants
+    return {'success': False, 'msg': _('Only sysadmins can purge the list of allowed users')}
+
+
+def index_queue_stats(context, data_dict):
+    # Only sysadmins can read the metrics of the index queue
+    return {'success': False, 'msg': _('Only sysadmins can read the metrics of the index queue')}
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import ckan.plugins.toolkit as tk
+
+
+CACHE_ATTR = '_privatedatasets_cache'
+
+
+def _get_storage():
+    try:
+        storage = getattr(tk.c, CACHE_ATTR, None)
+        # Pylons context returns an empty string for missing attributes
+        if not isinstance(storage, dict):
+            storage = {}
+            setattr(tk.c, CACHE_ATTR, storage)
+        return storage
+    except (AttributeError, RuntimeError, TypeError):
+        # There is no request in progress (e.g. paster commands), so
+        # nothing can be cached
+        return {}
+
+
+def get_request_cache(name):
+    '''
+    Returns a dict that lives as long as the request being processed. Entries
+    must be keyed by package ID so they can be invalidated when the package
+    changes. Outside a request, a new (empty) dict is returned on each call.
+
+    :param name: The name of the cache
+    :type name: string
+
+    :returns: The cache
+    :rtype: dict
+    '''
+    return _get_storage().setdefault(name, {})
+
+
+def invalidate_package(package_id):
+    '''
+    Removes the entries related to the given package from all the request caches
+
+    :param package_id: The ID of the package that has been modified
+    :type package_id: string
+    '''
+    for entries in _get_storage().values():
+        entries.pop(package_id, None)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function
+
+import sys
+
+from ckan import model
+from ckan.lib.cli import CkanCommand
+
+from ckanext.privatedatasets import db
+
+
+class PrivateDatasetsCommand(CkanCommand):
+    '''Manages the database of the Private Datasets extension
+
+    Usage:
+      privatedatasets initdb
+        - Creates the allowed users table and the indexes that do not
+          exist yet. Run it after installing or upgrading the extension.
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'initdb':
+            self.initdb()
+        else:
+            print('Command %s not recognized' % cmd)
+            sys.exit(1)
+
+    def initdb(self):
+        db.init_db(model)
+
+        created = db.create_missing_indexes(db.package_allowed_users_table)
+        for index_name in created:
+            print('Index %s created' % index_name)
+
+        print('Private Datasets tables are up to date')
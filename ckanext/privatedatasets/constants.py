@@ -25,3 +25,5 @@ ACQUIRE_URL = 'acquire_url'
 CONTEXT_CALLBACK = 'updating_via_cb'
 PACKAGE_ACQUIRED = 'package_acquired'
 PACKAGE_DELETED = 'revoke_access'
+PURGE_ACCESS = 'purge_access'
+INDEX_QUEUE_STATS = 'index_queue_stats'
@@ -23,15 +23,49 @@ from __future__ import absolute_import
 from itertools import count
 import re
 
-from ckan.plugins import toolkit
 from ckan.common import _
 import six
 
-from ckanext.privatedatasets import constants, db
+from ckanext.privatedatasets import auth, constants, db
+
+
+# Current private flag of the datasets validated with a context
+PRIVATE_CONTEXT_KEY = '__privatedatasets_private'
+
+# DJango Regular Expression to check URLs
+URL_REGEX = re.compile(
+    r'^https?://'  # scheme is validated separately
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}(?<!-)\.?)|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'  # ...or ipv4
+    r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'  # ...or ipv6
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+# Longer URLs are not valid. This bounds the time needed to validate a URL
+URL_MAX_LENGTH = 2048
+
+
+def _get_current_private(context, dataset_id):
+    # The checker is attached to several fields, so the flag is retrieved
+    # once per validation and shared through the context
+    private_flags = context.setdefault(PRIVATE_CONTEXT_KEY, {})
+
+    if dataset_id not in private_flags:
+        package = context['model'].Package.get(dataset_id)
+        private_flags[dataset_id] = package.private if package else None
+
+    return private_flags[dataset_id]
 
 
 def private_datasets_metadata_checker(key, data, errors, context):
 
+    metadata_value = data[key]
+
+    # Empty fields are always valid
+    if not metadata_value:
+        return
+
     dataset_id = data.get(('id',))
     private_val = data.get(('private',))
 
@@ -42,14 +76,12 @@ def private_datasets_metadata_checker(key, data, errors, context):
 
     # If the private field is not included in the data dict, we must check the current value
     if private_val is None and dataset_id:
-        dataset_dict = toolkit.get_action('package_show')({'ignore_auth': True}, {'id': dataset_id})
-        private_val = dataset_dict.get('private')
+        private_val = _get_current_private(context, dataset_id)
 
     private = private_val is True if isinstance(private_val, bool) else private_val == 'True'
-    metadata_value = data[key]
 
     # If allowed users are included and the dataset is not private outside and organization, an error will be raised.
-    if metadata_value and not private:
+    if not private:
         errors[key].append(_('This field is only valid when you create a private dataset'))
 
 
@@ -81,27 +113,33 @@ def allowed_users_convert(key, data, errors, context):
 def get_allowed_users(key, data, errors, context):
     pkg_id = data[('id',)]
 
-    db.init_db(context['model'])
+    # package_show (which always sets auth_user_obj) removes the list when the
+    # user cannot see it, so it is not loaded. Other callers (e.g. the search
+    # index) always get it
+    if 'auth_user_obj' in context and not auth.can_see_allowed_users(
+            context, data.get(('private',)), data.get(('creator_user_id',))):
+        return
+
+    for i, user_name in enumerate(db.AllowedUser.get_user_names(pkg_id)):
+        data[(key[0], i)] = user_name
+
+
+def is_valid_url(url):
+    '''
+    Checks whether the given string is a valid HTTP(S) URL. Strings longer
+    than URL_MAX_LENGTH are rejected before evaluating the regular expression.
 
-    users = db.AllowedUser.get(package_id=pkg_id)
+    :param url: The URL to check
+    :type url: string
 
-    for i, user in enumerate(users):
-        data[(key[0], i)] = user.user_name
+    :rtype: bool
+    '''
+    return len(url) <= URL_MAX_LENGTH and URL_REGEX.match(url) is not None
 
 
 def url_checker(key, data, errors, context):
     url = data.get(key, None)
 
     if url:
-        # DJango Regular Expression to check URLs
-        regex = re.compile(
-            r'^https?://'  # scheme is validated separately
-            r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}(?<!-)\.?)|'  # domain...
-            r'localhost|'  # localhost...
-            r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'  # ...or ipv4
-            r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'  # ...or ipv6
-            r'(?::\d+)?'  # optional port
-            r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-
-        if regex.match(url) is None:
+        if not is_valid_url(url):
             errors[key].append(_('The URL "%s" is not valid.') % url)
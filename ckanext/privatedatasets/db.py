@@ -19,14 +19,34 @@
 
 from __future__ import absolute_import
 
+import collections
+
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from ckanext.privatedatasets import cache
 
 AllowedUser = None
+package_allowed_users_table = None
+
+ACL_CACHE = 'acl'
+
+USER_INDEX = 'idx_package_allowed_users_user_name'
+
+# Maximum number of rows inserted or deleted by each statement
+WRITE_BATCH_SIZE = 1000
 
 
 def init_db(model):
+    '''
+    Maps the allowed users table and creates it if it does not exist. It is
+    called once when the plugin is configured. Indexes missing in tables created
+    by previous versions are created by the "privatedatasets initdb" command.
 
-    global AllowedUser
+    :param model: The CKAN model
+    :type model: module
+    '''
+    global AllowedUser, package_allowed_users_table
     if AllowedUser is None:
 
         class _AllowedUser(model.DomainObject):
@@ -37,6 +57,61 @@ def init_db(model):
                 query = model.Session.query(cls).autoflush(False)
                 return query.filter_by(**kw).all()
 
+            @classmethod
+            def exists(cls, package_id, user_name):
+                '''Checks whether the user has been granted access to the package without loading any instance.'''
+                query = model.Session.query(cls.package_id).autoflush(False)
+                query = query.filter(cls.package_id == package_id, cls.user_name == user_name)
+                return model.Session.query(query.exists()).scalar()
+
+            @classmethod
+            def get_user_names(cls, package_id):
+                '''Returns the names of the users that have been granted access to the package.'''
+                query = model.Session.query(cls.user_name).autoflush(False)
+                return [user_name for (user_name,) in query.filter(cls.package_id == package_id)]
+
+            @classmethod
+            def get_package_ids(cls, user_name, package_ids):
+                '''Returns the IDs of the given packages that the user has been granted access to.'''
+                query = model.Session.query(cls.package_id).autoflush(False)
+                query = query.filter(cls.user_name == user_name, cls.package_id.in_(package_ids))
+                return set(package_id for (package_id,) in query)
+
+            @classmethod
+            def get_acquired_package_ids(cls, user_name, limit=None, offset=0):
+                '''Returns the IDs of the active packages that the user has been granted access to.
+                Recently modified packages come first.'''
+                query = model.Session.query(cls.package_id).autoflush(False)
+                query = query.join(model.Package, model.Package.id == cls.package_id)
+                query = query.filter(cls.user_name == user_name, model.Package.state == 'active')
+                query = query.order_by(model.Package.metadata_modified.desc(), model.Package.id)
+                query = query.offset(offset)
+                if limit is not None:
+                    query = query.limit(limit)
+                return [package_id for (package_id,) in query]
+
+            @classmethod
+            def add_all(cls, pairs):
+                '''Inserts the given (package_id, user_name) pairs. Pairs that are already stored
+                (even by a concurrent transaction) are skipped. Returns the inserted pairs.'''
+                return insert_grants(model.Session, package_allowed_users_table, pairs)
+
+            @classmethod
+            def delete_all(cls, pairs):
+                '''Deletes the given (package_id, user_name) pairs. Returns the deleted pairs.'''
+                return delete_grants(model.Session, package_allowed_users_table, pairs)
+
+            @classmethod
+            def delete_by_packages(cls, package_ids):
+                '''Deletes all the grants of the given packages with a single statement.
+                Returns the IDs of the packages that had grants.'''
+                if not package_ids:
+                    return set()
+                result = model.Session.execute(package_allowed_users_table.delete()
+                                               .where(package_allowed_users_table.c.package_id.in_(list(package_ids)))
+                                               .returning(package_allowed_users_table.c.package_id))
+                return set(package_id for (package_id,) in result)
+
         AllowedUser = _AllowedUser
 
         # FIXME: Maybe a default value should not be included...
@@ -45,9 +120,160 @@ def init_db(model):
             model.meta.metadata,
             sa.Column('package_id', sa.types.UnicodeText, primary_key=True, default=u''),
             sa.Column('user_name', sa.types.UnicodeText, primary_key=True, default=u''),
+            # The primary key is used for lookups by package. This index is
+            # used for lookups by user (e.g. acquisitions_list)
+            sa.Index(USER_INDEX, 'user_name', 'package_id'),
         )
 
         # Create the table only if it does not exist
         package_allowed_users_table.create(checkfirst=True)
 
         model.meta.mapper(AllowedUser, package_allowed_users_table,)
+
+
+def _batches(pairs):
+    # Rows are always written in the same order so concurrent transactions cannot deadlock
+    pairs = sorted(set(pairs))
+    for i in range(0, len(pairs), WRITE_BATCH_SIZE):
+        yield pairs[i:i + WRITE_BATCH_SIZE]
+
+
+def _package_batches(pairs):
+    # Same as _batches, but each batch only contains users of the same package
+    package_users = collections.OrderedDict()
+    for package_id, user_name in sorted(set(pairs)):
+        package_users.setdefault(package_id, []).append(user_name)
+
+    for package_id, user_names in package_users.items():
+        for i in range(0, len(user_names), WRITE_BATCH_SIZE):
+            yield package_id, user_names[i:i + WRITE_BATCH_SIZE]
+
+
+def insert_grants(session, table, pairs):
+    '''
+    Inserts the given grants using INSERT ... ON CONFLICT DO NOTHING statements
+    of up to WRITE_BATCH_SIZE rows. Grants that are already stored, even by a
+    concurrent transaction, are skipped. Requires PostgreSQL 9.5 or later.
+
+    :param session: The session used to execute the statements
+    :type session: sqlalchemy.orm.Session
+
+    :param table: The allowed users table
+    :type table: sqlalchemy.Table
+
+    :param pairs: The (package_id, user_name) pairs to insert
+    :type pairs: list
+
+    :returns: The inserted pairs
+    :rtype: set
+    '''
+    inserted = set()
+    for batch in _batches(pairs):
+        statement = postgresql.insert(table).values(
+            [{'package_id': package_id, 'user_name': user_name} for (package_id, user_name) in batch])
+        result = session.execute(statement.on_conflict_do_nothing().returning(table.c.package_id, table.c.user_name))
+        inserted.update((package_id, user_name) for (package_id, user_name) in result)
+
+    return inserted
+
+
+def delete_grants(session, table, pairs):
+    '''
+    Deletes the given grants using statements of up to WRITE_BATCH_SIZE rows
+    of the same package, so the rows are found using the primary key
+
+    :param session: The session used to execute the statements
+    :type session: sqlalchemy.orm.Session
+
+    :param table: The allowed users table
+    :type table: sqlalchemy.Table
+
+    :param pairs: The (package_id, user_name) pairs to delete
+    :type pairs: list
+
+    :returns: The deleted pairs
+    :rtype: set
+    '''
+    deleted = set()
+    for package_id, user_names in _package_batches(pairs):
+        condition = sa.and_(table.c.package_id == package_id, table.c.user_name.in_(user_names))
+        result = session.execute(table.delete().where(condition).returning(table.c.package_id, table.c.user_name))
+        deleted.update((package_id, user_name) for (package_id, user_name) in result)
+
+    return deleted
+
+
+def create_missing_indexes(table):
+    '''
+    Creates the indexes of the given table that do not exist in the database
+
+    :param table: The table whose indexes will be created
+    :type table: sqlalchemy.Table
+
+    :returns: The names of the created indexes
+    :rtype: list
+    '''
+    inspector = sa.inspect(table.bind)
+    existing = set(index['name'] for index in inspector.get_indexes(table.name))
+
+    created = []
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        if index.name not in existing:
+            index.create(table.bind)
+            created.append(index.name)
+
+    return created
+
+
+def is_allowed(package_id, user_name):
+    '''
+    Checks whether the given user is in the list of allowed users of a package.
+    Results are cached until the end of the request, so the database is only
+    queried once for each package and user.
+
+    :param package_id: The ID of the package
+    :type package_id: string
+
+    :param user_name: The name of the user
+    :type user_name: string
+
+    :returns: True if the user has been granted access to the package
+    :rtype: bool
+    '''
+    if not user_name:
+        return False
+
+    package_acl = cache.get_request_cache(ACL_CACHE).setdefault(package_id, {})
+
+    if user_name not in package_acl:
+        package_acl[user_name] = bool(AllowedUser.exists(package_id, user_name))
+
+    return package_acl[user_name]
+
+
+def get_allowed_packages(package_ids, user_name):
+    '''
+    Bulk version of is_allowed. The grants that are not cached yet are
+    retrieved with a single query and cached until the end of the request.
+
+    :param package_ids: The IDs of the packages
+    :type package_ids: list
+
+    :param user_name: The name of the user
+    :type user_name: string
+
+    :returns: The IDs of the packages the user has been granted access to
+    :rtype: set
+    '''
+    if not user_name or not package_ids:
+        return set()
+
+    acl = cache.get_request_cache(ACL_CACHE)
+    pending = set(package_id for package_id in package_ids if user_name not in acl.get(package_id, {}))
+
+    if pending:
+        granted = AllowedUser.get_package_ids(user_name, pending)
+        for package_id in pending:
+            acl.setdefault(package_id, {})[user_name] = package_id in granted
+
+    return set(package_id for package_id in package_ids if acl[package_id][user_name])
@@ -34,13 +34,19 @@ log = logging.getLogger(__name__)
 
 
 def is_dataset_acquired(pkg_dict):
+    return db.is_allowed(pkg_dict['id'], tk.c.user)
 
-    db.init_db(model)
 
-    if tk.c.user:
-        return len(db.AllowedUser.get(package_id=pkg_dict['id'], user_name=tk.c.user)) > 0
-    else:
-        return False
+def preload_acquired_datasets(packages):
+    '''
+    Retrieves with a single query whether the current user has acquired the
+    given packages, so is_dataset_acquired does not query the database for
+    each item of a list. It returns an empty string so it can be used in
+    templates.
+    '''
+    package_ids = [package['id'] for package in packages or []]
+    db.get_allowed_packages(package_ids, tk.c.user)
+    return ''
 
 
 def is_owner(pkg_dict):
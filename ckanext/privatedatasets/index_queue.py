@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+import uuid
+
+import ckan.plugins.toolkit as tk
+
+
+log = logging.getLogger(__name__)
+
+
+class IndexQueue(object):
+    '''
+    Buffers the packages whose search index documents have to be updated.
+    Repeated requests for the same package are coalesced and, every
+    `interval` seconds, the pending packages are sent to the CKAN job queue
+    in batches. If a batch cannot be enqueued (e.g. Redis is not available),
+    its packages are appended to a spool file and sent in the next flush.
+
+    :param job: The function executed by the background jobs. It receives
+        the list of package IDs to update.
+    :type job: function
+
+    :param interval: Seconds between flushes
+    :type interval: float
+
+    :param batch_size: Maximum number of packages of each job
+    :type batch_size: int
+
+    :param spool_path: Path of the spool file
+    :type spool_path: string
+    '''
+
+    def __init__(self, job, interval, batch_size, spool_path):
+        self.job = job
+        self.interval = interval
+        self.batch_size = batch_size
+        self.spool_path = spool_path
+
+        self._lock = threading.Lock()
+        self._spool_lock = threading.Lock()
+        # package_id -> time when it was first added
+        self._pending = collections.OrderedDict()
+        self._thread = None
+
+    def add(self, package_ids):
+        '''
+        Adds the given packages to the queue. Packages that are already
+        pending are not added again.
+
+        :param package_ids: The IDs of the packages
+        :type package_ids: list
+        '''
+        now = time.time()
+        with self._lock:
+            for package_id in package_ids:
+                self._pending.setdefault(package_id, now)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='privatedatasets-index-queue')
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def stats(self):
+        '''
+        Returns the metrics of the queue: the number of pending packages
+        (`depth`), the seconds the oldest one has been waiting (`lag`) and the
+        number of packages waiting in the spool file (`spooled`).
+
+        :rtype: dict
+        '''
+        with self._lock:
+            depth = len(self._pending)
+            oldest = next(iter(self._pending.values()), None)
+
+        return {
+            'depth': depth,
+            'lag': time.time() - oldest if oldest is not None else 0,
+            'spooled': len(self._read_spool(consume=False))
+        }
+
+    def flush(self):
+        '''
+        Sends the pending packages, including the spooled ones, to the job queue
+        '''
+        stats = self.stats()
+
+        with self._lock:
+            pending = list(self._pending.keys())
+            self._pending.clear()
+
+        package_ids = list(collections.OrderedDict.fromkeys(self._read_spool() + pending))
+        if not package_ids:
+            return
+
+        log.info('Flushing the index queue: %d packages (depth %d, lag %.1fs, spooled %d)',
+                 len(package_ids), stats['depth'], stats['lag'], stats['spooled'])
+
+        for i in range(0, len(package_ids), self.batch_size):
+            batch = package_ids[i:i + self.batch_size]
+            try:
+                tk.enqueue_job(self.job, [batch], title='Update the search index of %d datasets' % len(batch))
+            except Exception as e:
+                log.warn('Unable to enqueue the index update, %d packages spooled: %s', len(batch), e)
+                self._write_spool(batch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Error flushing the index queue')
+
+    def _write_spool(self, package_ids):
+        with self._spool_lock:
+            with open(self.spool_path, 'a') as spool:
+                spool.write(''.join('%s\n' % package_id for package_id in package_ids))
+
+    def _read_spool(self, consume=True):
+        with self._spool_lock:
+            path = self.spool_path
+            if consume:
+                # The file is renamed before reading it, so other processes
+                # sharing the spool cannot read the same packages
+                path = '%s.%s' % (self.spool_path, uuid.uuid4().hex)
+                try:
+                    os.rename(self.spool_path, path)
+                except OSError:
+                    return []
+
+            try:
+                with open(path) as spool:
+                    package_ids = [line.strip() for line in spool if line.strip()]
+            except IOError:
+                return []
+
+            if consume:
+                os.remove(path)
+
+            return package_ids
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import tempfile
+
+from ckan import model
+from ckan.lib import plugins as lib_plugins, search
+import ckan.plugins.toolkit as tk
+import pysolr
+
+from ckanext.privatedatasets import constants, db, helpers
+from ckanext.privatedatasets.index_queue import IndexQueue
+
+
+log = logging.getLogger(__name__)
+
+PARTIAL_UPDATE_CONFIG_PROP = 'ckan.privatedatasets.partial_index_update'
+ASYNC_UPDATE_CONFIG_PROP = 'ckan.privatedatasets.async_index_update'
+ASYNC_INTERVAL_CONFIG_PROP = 'ckan.privatedatasets.async_index_update.interval'
+ASYNC_BATCH_SIZE_CONFIG_PROP = 'ckan.privatedatasets.async_index_update.batch_size'
+ASYNC_SPOOL_CONFIG_PROP = 'ckan.privatedatasets.async_index_update.spool'
+
+# Stored fields that depend on the list of allowed users
+DATA_DICT_FIELDS = ['data_dict', 'validated_data_dict']
+
+# Fields set by the atomic updates (see _update_acl_fields)
+ACL_FIELDS = ['permission_labels'] + DATA_DICT_FIELDS
+
+# Solr limits the number of clauses of a query
+SEARCH_MAX_IDS = 500
+
+# The queue is created when it is used for the first time (see get_queue)
+_queue = None
+
+# The Solr schema is checked before the first atomic update (see _get_unsupported_fields)
+_unsupported_fields = None
+
+
+def _get_schema(conn, path, key):
+    return json.loads(conn._send_request('get', 'schema/%s?wt=json&showDefaults=true' % path))[key]
+
+
+def _get_unsupported_fields(conn):
+    '''
+    Returns the fields of the Solr schema that prevent atomic updates. Solr
+    rebuilds the documents from their stored fields, so the values of the
+    fields that are neither stored nor docValues would be lost, unless they
+    are populated with copyField. The schema is only read once.
+
+    :returns: The names of the fields
+    :rtype: list
+    '''
+    global _unsupported_fields
+
+    if _unsupported_fields is None:
+        copy_fields = set(field['dest'] for field in _get_schema(conn, 'copyfields', 'copyFields'))
+        fields = _get_schema(conn, 'fields', 'fields') + _get_schema(conn, 'dynamicfields', 'dynamicFields')
+
+        unsupported_fields = []
+        for field in fields:
+            if field.get('stored', True) or field.get('docValues', False):
+                continue
+            # Internal fields (e.g. _version_) are maintained by Solr and the
+            # ACL fields are set by the update itself
+            if field['name'] in copy_fields or field['name'] in ACL_FIELDS or field['name'].startswith('_'):
+                continue
+            unsupported_fields.append(field['name'])
+
+        _unsupported_fields = sorted(unsupported_fields)
+
+    return _unsupported_fields
+
+
+def _get_acl_updates(conn, package_ids):
+    site_id = tk.config.get('ckan.site_id')
+    labels = lib_plugins.get_permission_labels()
+
+    fq = ['+site_id:"%s"' % site_id,
+          '+id:(%s)' % ' OR '.join('"%s"' % package_id for package_id in package_ids)]
+    results = conn.search(q='*:*', fq=fq, fl='id,index_id,' + ','.join(DATA_DICT_FIELDS), rows=len(package_ids))
+
+    updates = {}
+    for doc in results:
+        package = model.Package.get(doc['id'])
+        if package is None:
+            continue
+
+        allowed_users = db.AllowedUser.get_user_names(package.id)
+
+        update = {'index_id': doc['index_id'], 'permission_labels': labels.get_dataset_labels(package)}
+        for field in DATA_DICT_FIELDS:
+            data = json.loads(doc[field])
+            if constants.ALLOWED_USERS in data:
+                data[constants.ALLOWED_USERS] = allowed_users
+            update[field] = json.dumps(data)
+
+        updates[package.id] = update
+
+    return updates
+
+
+def _update_acl_fields(package_ids):
+    '''
+    Updates only the ACL related fields of the documents of the given packages
+    using Solr atomic updates. Changes are not committed. When the Solr schema
+    cannot be read or it does not support atomic updates, no document is
+    updated.
+
+    :returns: The IDs of the packages that could not be updated
+    :rtype: list
+    '''
+    conn = search.make_connection()
+
+    try:
+        unsupported_fields = _get_unsupported_fields(conn)
+        if unsupported_fields:
+            log.warn('The Solr schema does not store the fields %s, the packages will be reindexed',
+                     ', '.join(unsupported_fields))
+            return package_ids
+
+        updated = set()
+        for i in range(0, len(package_ids), SEARCH_MAX_IDS):
+            updates = _get_acl_updates(conn, package_ids[i:i + SEARCH_MAX_IDS])
+            if updates:
+                field_updates = dict((field, 'set') for field in ACL_FIELDS)
+                conn.add(list(updates.values()), fieldUpdates=field_updates, commit=False)
+                updated.update(updates)
+    except (pysolr.SolrError, KeyError, ValueError) as e:
+        log.warn('Unable to update the ACL fields of the search index, the packages will be reindexed: %s', e)
+        return package_ids
+
+    return [package_id for package_id in package_ids if package_id not in updated]
+
+
+def get_queue():
+    '''
+    Returns the queue used to update the search index in the background
+
+    :rtype: ckanext.privatedatasets.index_queue.IndexQueue
+    '''
+    global _queue
+
+    if _queue is None:
+        default_spool = os.path.join(tempfile.gettempdir(), 'ckanext-privatedatasets-index-queue')
+        _queue = IndexQueue(reindex_packages,
+                            float(tk.config.get(ASYNC_INTERVAL_CONFIG_PROP, 5)),
+                            int(tk.config.get(ASYNC_BATCH_SIZE_CONFIG_PROP, 100)),
+                            tk.config.get(ASYNC_SPOOL_CONFIG_PROP, default_spool))
+
+    return _queue
+
+
+def update_index(package_ids):
+    '''
+    Updates the search index documents of the given packages, so the index
+    does not return outdated information after their list of allowed users
+    has been modified. When asynchronous updates are enabled, the packages
+    are added to the index queue and updated by a background job.
+
+    :param package_ids: The IDs of the packages to update
+    :type package_ids: list
+    '''
+    if not package_ids:
+        return
+
+    if helpers.get_config_bool_value(ASYNC_UPDATE_CONFIG_PROP):
+        get_queue().add(package_ids)
+    else:
+        reindex_packages(package_ids)
+
+
+def reindex_packages(package_ids):
+    '''
+    Updates the search index documents of the given packages. When partial
+    updates are enabled, only the ACL related fields of the documents are
+    updated; packages that are not indexed yet are fully reindexed. Solr
+    changes are committed once for all the packages.
+
+    :param package_ids: The IDs of the packages to update
+    :type package_ids: list
+    '''
+    if not package_ids:
+        return
+
+    if helpers.get_config_bool_value(PARTIAL_UPDATE_CONFIG_PROP):
+        package_ids = _update_acl_fields(list(package_ids))
+
+    indexer = search.PackageSearchIndex()
+
+    for package_id in package_ids:
+        try:
+            pkg_dict = tk.get_action('package_show')(
+                {'model': model,
+                 'ignore_auth': True,
+                 'validate': False,
+                 'use_cache': False},
+                {'id': package_id})
+
+            # Prevent acquired datasets jumping to the first position
+            revision = tk.get_action('revision_show')({'ignore_auth': True}, {'id': pkg_dict['revision_id']})
+        except tk.ObjectNotFound:
+            # The package may have been purged while it was waiting in the
+            # index queue. The rest of the packages are updated anyway
+            log.warn('Package %s not found, its search index document has not been updated', package_id)
+            continue
+
+        pkg_dict['metadata_modified'] = revision.get('timestamp', '')
+        indexer.update_dict(pkg_dict, defer_commit=True)
+
+    search.commit()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import ckan.plugins.toolkit as tk
+import six
+
+
+class BulkNotificationParser(object):
+    '''
+    Parser for notifications that include several users and datasets, so stores
+    can grant or revoke access in bulk (e.g. to reconcile their purchases):
+
+        {"users_datasets": [{"user": "user_name", "datasets": ["ds1", "ds2", ...]},
+                            {"user": "user_name2", "datasets": ["ds1", "ds4", ...]}]}
+
+    Datasets can be referenced by their name or their ID.
+    '''
+
+    def parse_notification(self, request_data):
+
+        if 'users_datasets' not in request_data:
+            raise tk.ValidationError({'message': 'users_datasets not found in the request'})
+
+        users_datasets = request_data['users_datasets']
+
+        if not isinstance(users_datasets, list):
+            raise tk.ValidationError({'message': 'Invalid users_datasets format'})
+
+        result = []
+        for user_datasets in users_datasets:
+            if not isinstance(user_datasets, dict) or 'user' not in user_datasets or 'datasets' not in user_datasets:
+                raise tk.ValidationError({'message': 'Invalid users_datasets format'})
+
+            user_name = user_datasets['user']
+            datasets = user_datasets['datasets']
+
+            if not isinstance(user_name, six.string_types):
+                raise tk.ValidationError({'message': 'Invalid user format'})
+
+            if not isinstance(datasets, list) or not all(isinstance(dataset, six.string_types) for dataset in datasets):
+                raise tk.ValidationError({'message': 'Invalid datasets format for the user %s' % user_name})
+
+            result.append({'user': user_name, 'datasets': datasets})
+
+        return {'users_datasets': result}
@@ -21,23 +21,25 @@
 from __future__ import absolute_import, unicode_literals
 
 from ckan import model, plugins as p
-from ckan.lib import search
 from ckan.lib.plugins import DefaultPermissionLabels
 from ckan.plugins import toolkit as tk
 from flask import Blueprint
 
-from ckanext.privatedatasets import auth, actions, constants, converters_validators as conv_val, db, helpers
+from ckanext.privatedatasets import auth, actions, cache, constants, converters_validators as conv_val, db, helpers, indexing
 from ckanext.privatedatasets.views import acquired_datasets
 
 
 HIDDEN_FIELDS = [constants.ALLOWED_USERS, constants.SEARCHABLE]
 
+GRANTED_USER_LABEL = 'granted-user-%s'
+
 
 class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissionLabels):
 
     p.implements(p.IDatasetForm)
     p.implements(p.IAuthFunctions)
     p.implements(p.IConfigurer)
+    p.implements(p.IConfigurable)
     p.implements(p.IBlueprint)
     p.implements(p.IRoutes, inherit=True)
     p.implements(p.IActions)
@@ -50,9 +52,6 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
     ############################ DATASET FORM ############################
     ######################################################################
 
-    def __init__(self, name=None):
-        self.indexer = search.PackageSearchIndex()
-
     def _modify_package_schema(self):
         return {
             # remove datasets_with_no_organization_cannot_be_private validator
@@ -117,7 +116,9 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
                           'resource_show': auth.resource_show,
                           constants.PACKAGE_ACQUIRED: auth.package_acquired,
                           constants.ACQUISITIONS_LIST: auth.acquisitions_list,
-                          constants.PACKAGE_DELETED: auth.revoke_access}
+                          constants.PACKAGE_DELETED: auth.revoke_access,
+                          constants.PURGE_ACCESS: auth.purge_access,
+                          constants.INDEX_QUEUE_STATS: auth.index_queue_stats}
 
         return auth_functions
 
@@ -136,6 +137,17 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
         # Register this plugin's fanstatic directory with CKAN.
         tk.add_resource(b'fanstatic', b'privatedatasets')
 
+        # Load the notification parser, so configuration errors are detected on startup
+        actions.load_parser(config)
+
+    ######################################################################
+    ########################### ICONFIGURABLE ############################
+    ######################################################################
+
+    def configure(self, config):
+        # Map the allowed users table once, so requests do not have to
+        db.init_db(model)
+
     ######################################################################
     ############################# IBLUEPRINT #############################
     ######################################################################
@@ -161,7 +173,9 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
     def get_actions(self):
         action_functions = {constants.PACKAGE_ACQUIRED: actions.package_acquired,
                             constants.ACQUISITIONS_LIST: actions.acquisitions_list,
-                            constants.PACKAGE_DELETED: actions.revoke_access}
+                            constants.PACKAGE_DELETED: actions.revoke_access,
+                            constants.PURGE_ACCESS: actions.purge_access,
+                            constants.INDEX_QUEUE_STATS: actions.index_queue_stats}
 
         return action_functions
 
@@ -186,53 +200,32 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
 
     def after_create(self, context, pkg_dict):
         session = context['session']
-        update_cache = False
-
-        db.init_db(context['model'])
 
         # Get the users and the package ID
         if constants.ALLOWED_USERS in pkg_dict:
 
-            allowed_users = pkg_dict[constants.ALLOWED_USERS]
+            allowed_users = set(pkg_dict[constants.ALLOWED_USERS])
             package_id = pkg_dict['id']
 
             # Get current users
-            users = db.AllowedUser.get(package_id=package_id)
-
-            # Delete users and save the list of current users
-            current_users = []
-            for user in users:
-                current_users.append(user.user_name)
-                if user.user_name not in allowed_users:
-                    session.delete(user)
-                    update_cache = True
-
-            # Add non existing users
-            for user_name in allowed_users:
-                if user_name not in current_users:
-                    out = db.AllowedUser()
-                    out.package_id = package_id
-                    out.user_name = user_name
-                    out.save()
-                    session.add(out)
-                    update_cache = True
-
-            session.commit()
-
-            # The cache should be updated. Otherwise, the system may return
-            # outdated information in future requests
-            if update_cache:
-                new_pkg_dict = tk.get_action('package_show')(
-                    {'model': context['model'],
-                     'ignore_auth': True,
-                     'validate': False,
-                     'use_cache': False},
-                    {'id': package_id})
-
-                # Prevent acquired datasets jumping to the first position
-                revision = tk.get_action('revision_show')({'ignore_auth': True}, {'id': new_pkg_dict['revision_id']})
-                new_pkg_dict['metadata_modified'] = revision.get('timestamp', '')
-                self.indexer.update_dict(new_pkg_dict)
+            current_users = set(db.AllowedUser.get_user_names(package_id))
+
+            users_to_delete = current_users - allowed_users
+            users_to_add = allowed_users - current_users
+
+            if users_to_delete or users_to_add:
+                # Changes are applied with one statement each and committed at once
+                db.AllowedUser.delete_all([(package_id, user_name) for user_name in sorted(users_to_delete)])
+                db.AllowedUser.add_all([(package_id, user_name) for user_name in sorted(users_to_add)])
+                session.commit()
+
+                # The cache should be updated. Otherwise, the system may return
+                # outdated information in future requests
+                indexing.update_index([package_id])
+
+        # Permissions cached during the request depend on the package
+        # (e.g. its visibility), so they are discarded on every change
+        cache.invalidate_package(pkg_dict['id'])
 
         return pkg_dict
 
@@ -251,14 +244,7 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
             del pkg_dict['resources']
             del pkg_dict['num_resources']
 
-        user_obj = context.get('auth_user_obj')
-        updating_via_api = context.get(constants.CONTEXT_CALLBACK, False)
-
-        # allowed_users and searchable fileds can be only viewed by (and only if the dataset is private):
-        # * the dataset creator
-        # * the sysadmin
-        # * users allowed to update the allowed_users list via the notification API
-        if pkg_dict.get('private') is False or not updating_via_api and (not user_obj or (pkg_dict['creator_user_id'] != user_obj.id and not user_obj.sysadmin)):
+        if not auth.can_see_allowed_users(context, pkg_dict.get('private'), pkg_dict.get('creator_user_id')):
             # The original list cannot be modified
             attrs = list(HIDDEN_FIELDS)
             self._delete_pkg_atts(pkg_dict, attrs)
@@ -269,37 +255,46 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
         session = context['session']
         package_id = pkg_dict['id']
 
-        # Get current users
-        db.init_db(context['model'])
-        users = db.AllowedUser.get(package_id=package_id)
-
         # Delete all the users
-        for user in users:
-            session.delete(user)
+        db.AllowedUser.delete_by_packages([package_id])
         session.commit()
 
+        cache.invalidate_package(package_id)
+
         return pkg_dict
 
+    def _is_readable_result(self, result):
+        return result.get('state') == 'active' and not result.get('private')
+
     def after_search(self, search_results, search_params):
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': tk.c.user,
+            'auth_user_obj': tk.c.userobj
+        }
+
+        # Resources should not be included if the user is not allowed to read
+        # them. Active datasets that are public can be read. The permissions of
+        # the other results are resolved at once (the allowed users stored in
+        # the index may be outdated)
+        readable_packages = set()
+        pending = []
+        for result in search_results['results']:
+            if self._is_readable_result(result):
+                readable_packages.add(result['id'])
+            else:
+                pending.append(result)
+
+        if pending:
+            readable_packages.update(auth.get_readable_packages(context, pending))
+
         for result in search_results['results']:
             # Extra fields should not be returned
             # The original list cannot be modified
             attrs = list(HIDDEN_FIELDS)
 
-            # Additionally, resources should not be included if the user is not allowed
-            # to show the resource
-            context = {
-                'model': model,
-                'session': model.Session,
-                'user': tk.c.user,
-                'user_obj': tk.c.userobj
-            }
-
-            try:
-                tk.check_access('package_show', context, result)
-            except tk.NotAuthorized:
-                # NotAuthorized exception is risen when the user is not allowed
-                # to read the package.
+            if result['id'] not in readable_packages:
                 attrs.append('resources')
             # Delete
             self._delete_pkg_atts(result, attrs)
@@ -309,7 +304,9 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
     ####
     def before_view(self, pkg_dict):
 
-        for resource in pkg_dict['resources']:
+        resources = pkg_dict.get('resources', [])
+
+        if resources:
 
             context = {
                 'model': model,
@@ -318,11 +315,13 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
                 'user_obj': tk.c.userobj
             }
 
+            # All the resources belong to the same package, so the user can see
+            # either all of them or none of them
             try:
-                tk.check_access('resource_show', context, resource)
+                tk.check_access('resource_show', context, resources[0])
             except tk.NotAuthorized:
-                pkg_dict['resources'].remove(resource)
-                pkg_dict = self.before_view(pkg_dict)
+                pkg_dict['resources'] = []
+
         return pkg_dict
 
     def get_dataset_labels(self, dataset_obj):
@@ -332,6 +331,11 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
         if getattr(dataset_obj, 'searchable', False):
             labels.append('searchable')
 
+        # Private datasets can be found by the users they have been shared with
+        if dataset_obj.private:
+            labels.extend(GRANTED_USER_LABEL % user_name
+                          for user_name in db.AllowedUser.get_user_names(dataset_obj.id))
+
         return labels
 
     def get_user_dataset_labels(self, user_obj):
@@ -339,6 +343,10 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
             user_obj)
 
         labels.append('searchable')
+
+        if user_obj:
+            labels.append(GRANTED_USER_LABEL % user_obj.name)
+
         return labels
 
     ######################################################################
@@ -363,9 +371,24 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
             'user_obj': tk.c.userobj
         }
 
-        try:
-            tk.check_access('resource_show', context, resource_dict)
-        except tk.NotAuthorized:
+        package_id = resource_dict.get('package_id')
+        user_obj = tk.c.userobj
+
+        if package_id and user_obj and user_obj.sysadmin:
+            # Sysadmins can read all the resources
+            authorized = True
+        elif package_id:
+            # The permission is computed once for all the resources of the package
+            context['auth_user_obj'] = user_obj
+            authorized = auth.can_read_resources(context, package_id)
+        else:
+            try:
+                tk.check_access('resource_show', context, resource_dict)
+                authorized = True
+            except tk.NotAuthorized:
+                authorized = False
+
+        if not authorized:
             resource_dict.clear()
         return resource_dict
 
@@ -380,5 +403,6 @@ class PrivateDatasets(p.SingletonPlugin, tk.DefaultDatasetForm, DefaultPermissio
                 'can_read': helpers.can_read,
                 'show_acquire_url_on_create': helpers.show_acquire_url_on_create,
                 'show_acquire_url_on_edit': helpers.show_acquire_url_on_edit,
-                'acquire_button': helpers.acquire_button
+                'acquire_button': helpers.acquire_button,
+                'preload_acquired_datasets': helpers.preload_acquired_datasets
                 }
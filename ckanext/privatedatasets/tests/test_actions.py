@@ -18,9 +18,11 @@
 # along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
 
 import ckanext.privatedatasets.actions as actions
+import collections
+import re
 import unittest
 
-from mock import MagicMock
+from mock import call, MagicMock
 from parameterized import parameterized
 
 PARSER_CONFIG_PROP = 'ckan.privatedatasets.parser'
@@ -28,6 +30,9 @@ IMPORT_ERROR_MSG = 'Unable to load the module'
 CLASS_NAME = 'parser_class'
 ADD_USERS_ERROR = 'Error updating the dataset'
 
+# Rows returned when the datasets of a notification are resolved
+Package = collections.namedtuple('Package', ['id', 'name', 'private', 'state'])
+
 
 class ActionsTest(unittest.TestCase):
 
@@ -43,11 +48,32 @@ class ActionsTest(unittest.TestCase):
         self._db = actions.db
         actions.db = MagicMock()
 
+        self._helpers = actions.helpers
+        actions.helpers = MagicMock()
+        actions.helpers.get_config_bool_value.return_value = False
+
+        self._cache = actions.cache
+        actions.cache = MagicMock()
+
+        self._indexing = actions.indexing
+        actions.indexing = MagicMock()
+
+        self._sa = actions.sa
+        actions.sa = MagicMock()
+
+        # The parser is loaded again in each test
+        actions._parser = None
+
     def tearDown(self):
         # Unmock
         actions.importlib = self._importlib
         actions.plugins = self._plugins
         actions.db = self._db
+        actions.helpers = self._helpers
+        actions.cache = self._cache
+        actions.indexing = self._indexing
+        actions.sa = self._sa
+        actions._parser = None
 
     @parameterized.expand([
         ('',              None,       False, False, '%s not configured' % PARSER_CONFIG_PROP),
@@ -77,20 +103,43 @@ class ActionsTest(unittest.TestCase):
         
         if expected_error:
             with self.assertRaises(actions.plugins.toolkit.ValidationError) as cm:
-                actions.package_acquired({}, {})
+                actions.package_acquired({'model': MagicMock()}, {})
             self.assertEqual(cm.exception.error_dict['message'], expected_error)
         else:
             # Exception is not risen
-            self.assertEquals(None, actions.package_acquired({}, {}))
+            self.assertEquals(None, actions.package_acquired({'model': MagicMock()}, {}))
 
         # Checks
         self.assertEquals(0, actions.plugins.toolkit.get_action.call_count)
 
+    def test_parser_loaded_once(self):
+        actions.plugins.toolkit.config = {PARSER_CONFIG_PROP: 'valid.path:%s' % CLASS_NAME}
+        package = MagicMock()
+        actions.importlib.import_module = MagicMock(return_value=package)
+
+        parser = actions.load_parser(actions.plugins.toolkit.config)
+        self.assertEquals(package.parser_class.return_value, parser)
+
+        actions.package_acquired({'model': MagicMock()}, {})
+        actions.package_acquired({'model': MagicMock()}, {})
+
+        # The parser is not instantiated again when processing notifications
+        actions.importlib.import_module.assert_called_once_with('valid.path')
+        package.parser_class.assert_called_once_with()
+        self.assertEquals(2, parser.parse_notification.call_count)
+
+    def test_load_parser_not_configured(self):
+        self.assertIsNone(actions.load_parser({}))
+        self.assertEquals(0, actions.importlib.import_module.call_count)
+
     def configure_mocks(self, parse_result, datasets_not_found=[], not_updatable_datasets=[],
             allowed_users=None, creator_user={'id': '1234', 'name': 'ckan'}):
 
         actions.plugins.toolkit.config = {PARSER_CONFIG_PROP: 'valid.path:%s' % CLASS_NAME}
 
+        # Allowed users are updated using package_update
+        actions.helpers.get_config_bool_value.side_effect = lambda name: name == actions.USE_PACKAGE_UPDATE_CONFIG_PROP
+
         # Configure mocks
         parser_instance = MagicMock()
         parser_instance.parse_notification = MagicMock(return_value=parse_result)
@@ -117,24 +166,33 @@ class ActionsTest(unittest.TestCase):
             if data_dict['id'] in not_updatable_datasets:
                 raise actions.plugins.toolkit.ValidationError({'allowed_users': [ADD_USERS_ERROR]})
 
-        def _user_show(context, data_dict):
-            return {'name': creator_user['name'], 'id': data_dict['id']}
-
         package_show = MagicMock(side_effect=_package_show)
         package_update = MagicMock(side_effect=_package_update)
-        user_show = MagicMock(side_effect=_user_show)
+
+        # The name of the creator is read from the model
+        model = MagicMock()
+        model.User.get.return_value.name = creator_user['name']
+
+        # All the notified users exist
+        users = [(user_info['user'],) for user_info in parse_result['users_datasets']]
+
+        def _query(*columns):
+            query = MagicMock()
+            if columns == (model.User.name,):
+                query.filter.return_value = users
+            return query
+
+        model.Session.query.side_effect = _query
 
         def _get_action(action):
             if action == 'package_update':
                 return package_update
             elif action == 'package_show':
                 return package_show
-            elif action == 'user_show':
-                return user_show
 
         actions.plugins.toolkit.get_action = _get_action
 
-        return parser_instance.parse_notification, package_show, package_update, user_show
+        return parser_instance.parse_notification, package_show, package_update, model
 
     @parameterized.expand([
         # Simple Test: one user and one dataset
@@ -160,11 +218,11 @@ class ActionsTest(unittest.TestCase):
         parse_result = {'users_datasets': [{'user': user, 'datasets': users_info[user]} for user in users_info]}
         creator_user = {'name': 'ckan', 'id': '1234'}
 
-        parse_notification, package_show, package_update, user_show = self.configure_mocks(parse_result,
+        parse_notification, package_show, package_update, model = self.configure_mocks(parse_result,
                 datasets_not_found, not_updatable_datasets, allowed_users, creator_user)
 
         # Call the function
-        context = {'user': 'user1', 'model': 'model', 'auth_obj': {'id': 1}, 'method': 'grant'}
+        context = {'user': 'user1', 'model': model, 'auth_obj': {'id': 1}, 'method': 'grant'}
         result = actions.package_acquired(context, users_info)
 
         # Calculate the list of warns
@@ -207,47 +265,60 @@ class ActionsTest(unittest.TestCase):
 
                     package_update.assert_any_call(context_update, {'id': dataset_id, 'allowed_users': expected_allowed_users, 'private': True, 'creator_user_id': creator_user['id']})
 
+        # All the datasets have the same creator, so its name is only retrieved once
+        self.assertLessEqual(model.User.get.call_count, 1)
 
     @parameterized.expand([
-        (None,               {},),
-        ({},                 {2: actions.plugins.toolkit.ObjectNotFound},),
-        ({'user': 'fiware'}, {1: actions.plugins.toolkit.NotAuthorized},),
-        (None,               {1: actions.plugins.toolkit.NotAuthorized, 2: actions.plugins.toolkit.ObjectNotFound},),
-        ({},                 {},                                                                                    [1]),
-        ({'user': 'fiware'}, {},                                                                                    [3, 2]),
-        (None,               {1: actions.plugins.toolkit.NotAuthorized},                                            [2]),
-        ({},                 {1: actions.plugins.toolkit.NotAuthorized, 2: actions.plugins.toolkit.ObjectNotFound}, [1, 3]),
+        (None,                                            ['0', '1', '2', '3'], [],         None, 0),
+        ({},                                              ['0', '1', '2', '3'], ['2'],      None, 0),
+        ({'user': 'fiware'},                              ['0', '1', '2', '3'], [],         None, 0),
+        ({'limit': 2},                                    ['0', '1'],           [],         2,    0),
+        ({'user': 'fiware', 'limit': '2', 'offset': '4'}, ['4', '5'],           ['5'],      2,    4),
+        ({'offset': 1},                                   ['1', '2', '3'],      ['1', '3'], None, 1),
+        # Datasets are retrieved in chunks
+        ({},                                              ['0', '1', '2', '3'], [],         None, 0, 3),
+        ({},                                              ['0', '1', '2', '3'], ['3'],      None, 0, 1),
+        # Datasets purged after getting their IDs are not returned
+        ({},                                              ['0', '1', '2', '3'], ['1', '2'], None, 0, None, ['2']),
     ])
-    def test_acquisitions_list(self, data_dict, package_errors={}, deleted_packages=[]):
+    def test_acquisitions_list(self, data_dict, pkgs_ids, not_indexed, expected_limit, expected_offset, max_ids=None, purged=()):
 
-        pkgs_ids = [0, 1, 2, 3]
         user = 'example_user_test'
         actions.plugins.toolkit.c.user = user
 
+        if max_ids is not None:
+            self._search_max_ids = actions.SEARCH_MAX_IDS
+            actions.SEARCH_MAX_IDS = max_ids
+
         # get_action mock
-        default_package = {'pkg_id': 0, 'test': 'ok', 'res': 'ta'}
+        default_package = {'test': 'ok', 'res': 'ta'}
+
+        def _package_search(context, data_dict):
+            results = []
+            # Results are not returned in the requested order
+            for pkg_id in reversed(re.findall('"([^"]+)"', data_dict['fq'])):
+                if pkg_id not in not_indexed:
+                    pkg = default_package.copy()
+                    pkg['id'] = pkg_id
+                    results.append(pkg)
+            return {'count': len(results), 'results': results}
 
         def _package_show(context, data_dict):
-            if data_dict['id'] in package_errors:
-                raise package_errors[data_dict['id']]('ERROR')
-            else:
-                pkg = default_package.copy()
-                pkg['pkg_id'] = data_dict['id']
-                pkg['state'] = 'deleted' if data_dict['id'] in deleted_packages else 'active'
-                return pkg
+            if data_dict['id'] in purged:
+                raise actions.plugins.toolkit.ObjectNotFound()
+            pkg = default_package.copy()
+            pkg['id'] = data_dict['id']
+            pkg['shown'] = True
+            return pkg
 
+        package_search = MagicMock(side_effect=_package_search)
         package_show = MagicMock(side_effect=_package_show)
-        actions.plugins.toolkit.get_action.return_value = package_show
+        actions_mocks = {'package_search': package_search, 'package_show': package_show}
+        actions.plugins.toolkit.get_action.side_effect = lambda action: actions_mocks[action]
+        actions.plugins.toolkit.ObjectNotFound = self._plugins.toolkit.ObjectNotFound
 
         # query mock
-        query_res = []
-        for i in pkgs_ids:
-            pkg = MagicMock()
-            pkg.package_id = i
-            pkg.user_name = user
-            query_res.append(pkg)
-
-        actions.db.AllowedUser.get = MagicMock(return_value=query_res)
+        actions.db.AllowedUser.get_acquired_package_ids = MagicMock(return_value=pkgs_ids)
 
         # Context
         context = {
@@ -255,37 +326,110 @@ class ActionsTest(unittest.TestCase):
             'user': 'default_user'
         }
 
-        # Call the function
-        result = actions.acquisitions_list(context, data_dict)
+        try:
+            # Call the function
+            result = actions.acquisitions_list(context, data_dict)
+        finally:
+            if max_ids is not None:
+                actions.SEARCH_MAX_IDS = self._search_max_ids
 
         # Asset that check_access has been called
-        actions.plugins.toolkit.chec_access(actions.constants.ACQUISITIONS_LIST, context, data_dict)
-
-        # Check that the database has been initialized properly
-        actions.db.init_db.assert_called_once_with(context['model'])
+        expected_data_dict = {'user': context['user']} if data_dict is None else data_dict
+        actions.plugins.toolkit.check_access.assert_called_once_with(actions.constants.ACQUISITIONS_LIST, context, expected_data_dict)
 
         # Set expected user
         expected_user = data_dict['user'] if data_dict is not None and 'user' in data_dict else context['user']
 
         # Query called correctry
-        actions.db.AllowedUser.get.assert_called_once_with(user_name=expected_user)
-
-        # Assert that the package_show has been called properly
-        self.assertEquals(len(pkgs_ids), package_show.call_count)
-        for i in pkgs_ids:
-            package_show.assert_any_call(context, {'id': i})
-
-        # Check that the template receives the correct datasets
+        actions.db.AllowedUser.get_acquired_package_ids.assert_called_once_with(expected_user, expected_limit, expected_offset)
+
+        # Assert that the package_search has been called properly
+        chunk_size = max_ids or len(pkgs_ids)
+        chunks = [pkgs_ids[i:i + chunk_size] for i in range(0, len(pkgs_ids), chunk_size)]
+        self.assertEquals(len(chunks), package_search.call_count)
+        for chunk in chunks:
+            search_context = context.copy()
+            search_context['ignore_auth'] = True
+            package_search.assert_any_call(search_context, {
+                'fq': 'id:(%s)' % ' OR '.join('"%s"' % pkg_id for pkg_id in chunk),
+                'rows': len(chunk),
+                'include_private': True
+            })
+
+        # Datasets that are not indexed are retrieved with package_show
+        show_context = context.copy()
+        show_context['ignore_auth'] = True
+        self.assertEquals([call(show_context, {'id': pkg_id}) for pkg_id in not_indexed], package_show.call_args_list)
+
+        # Check that the template receives the correct datasets in the right order
         expected_acquired_datasets = []
         for i in pkgs_ids:
-            if i not in package_errors and i not in deleted_packages:
+            if i not in purged:
                 pkg = default_package.copy()
-                pkg['pkg_id'] = i
-                pkg['state'] = 'deleted' if i in deleted_packages else 'active'
+                pkg['id'] = i
+                if i in not_indexed:
+                    pkg['shown'] = True
                 expected_acquired_datasets.append(pkg)
 
         self.assertEquals(expected_acquired_datasets, result)
-    
+
+    @parameterized.expand([
+        ({'limit': -1},),
+        ({'limit': 'a'},),
+        ({'offset': -5},),
+        ({'offset': '1.5'},),
+    ])
+    def test_acquisitions_list_invalid_pagination(self, data_dict):
+        # Recover exception
+        actions.plugins.toolkit.ValidationError = self._plugins.toolkit.ValidationError
+
+        context = {
+            'model': MagicMock(),
+            'user': 'default_user'
+        }
+
+        with self.assertRaises(actions.plugins.toolkit.ValidationError):
+            actions.acquisitions_list(context, data_dict)
+
+        self.assertEquals(0, actions.db.AllowedUser.get_acquired_package_ids.call_count)
+
+    @parameterized.expand([
+        ('grant',  ['user1', 'user2', 'user3'], ['another_user', 'user2'], ['another_user', 'user2', 'user1', 'user3']),
+        ('revoke', ['user1', 'user2', 'user3'], ['user1', 'another_user', 'user3'], ['another_user']),
+        ('grant',  ['user1', 'user2'], ['user1', 'user2'], None),
+        ('revoke', ['user1', 'user2'], ['another_user'], None),
+    ])
+    def test_update_packages_grouped_by_dataset(self, method, users, allowed_users, expected_allowed_users):
+        parse_result = {'users_datasets': [{'user': user, 'datasets': ['ds1', 'ds2']} for user in users]}
+        creator_user = {'name': 'ckan', 'id': '1234'}
+
+        parse_notification, package_show, package_update, model = self.configure_mocks(parse_result,
+                ['ds2'], [], allowed_users, creator_user)
+
+        # Call the function
+        context = {'user': 'user1', 'model': model, 'auth_obj': {'id': 1}, 'method': method}
+        result = actions._process_package(context, {})
+
+        # A warn is returned for every user of the non existing dataset
+        self.assertEquals({'warns': ['Dataset ds2 was not found in this instance'] * len(users)}, result)
+
+        # Each dataset is locked and retrieved once
+        self.assertEquals(2, package_show.call_count)
+        lock_queries = [c for c in model.Session.query.call_args_list if c == call(model.Package.id)]
+        self.assertEquals(2, len(lock_queries))
+        self.assertEquals(2, model.Session.commit.call_count)
+
+        # The dataset is updated once including the changes of all the users
+        if expected_allowed_users is not None:
+            context_update = context.copy()
+            context_update['ignore_auth'] = True
+            context_update['user'] = creator_user['name']
+            package_update.assert_called_once_with(context_update, {'id': 'ds1', 'allowed_users': expected_allowed_users, 'private': True, 'creator_user_id': creator_user['id']})
+            model.User.get.assert_called_once_with(creator_user['id'])
+        else:
+            package_update.assert_not_called()
+            model.User.get.assert_not_called()
+
     @parameterized.expand([
         # Simple Test: one user and one dataset
         ({'user1': ['ds1']}, [],      [],      None), #Test with and non-existing list of allowed users
@@ -316,11 +460,11 @@ class ActionsTest(unittest.TestCase):
         for user in users_info:
             parse_result['users_datasets'].append({'user': user, 'datasets': users_info[user]})
 
-        parse_delete, package_show, package_update, user_show = self.configure_mocks(parse_result,
+        parse_delete, package_show, package_update, model = self.configure_mocks(parse_result,
                 datasets_not_found, not_updatable_datasets, allowed_users, creator_user)
 
         # Call the function
-        context = {'user': 'user1', 'model': 'model', 'auth_obj': {'id': 1}, 'method': 'revoke'}
+        context = {'user': 'user1', 'model': model, 'auth_obj': {'id': 1}, 'method': 'revoke'}
         result = actions.revoke_access(context, users_info)
 
         # Calculate the list of warns
@@ -362,3 +506,213 @@ class ActionsTest(unittest.TestCase):
                     context_update['user'] = creator_user['name']
 
                     package_update.assert_any_call(context_update, {'id': dataset_id, 'allowed_users': expected_allowed_users, 'private': True, 'creator_user_id': creator_user['id']})
+
+    @parameterized.expand([
+        # Simple Test: one user and one dataset
+        ('grant',  {'user1': ['ds1']}, [],      [],      [],                         ['ds1']),
+        ('grant',  {'user2': ['ds1']}, [],      [],      ['another_user'],           ['ds1']),
+        ('grant',  {'user3': ['ds1']}, [],      [],      ['another_user', 'user3'],  []),
+        ('grant',  {'user4': ['ds1']}, ['ds1'], [],      [],                         []),
+        ('grant',  {'user5': ['ds1']}, [],      ['ds1'], [],                         []),
+        ('grant',  {'user6': ['ds1', 'ds1']}, [], [],    [],                         ['ds1']),
+        ('revoke', {'user1': ['ds1']}, [],      [],      [],                         []),
+        ('revoke', {'user2': ['ds1']}, [],      [],      ['another_user'],           []),
+        ('revoke', {'user3': ['ds1']}, [],      [],      ['another_user', 'user3'],  ['ds1']),
+        ('revoke', {'user4': ['ds1']}, ['ds1'], [],      ['user4'],                  []),
+        ('revoke', {'user5': ['ds1']}, [],      ['ds1'], ['user5'],                  []),
+        ('revoke', {'user6': ['ds1', 'ds1']}, [], [],    ['user6'],                  ['ds1']),
+
+        # Complex test: some users and some datasets
+        ('grant',  {'user1': ['ds1', 'ds2', 'ds3', 'ds4'], 'user2': ['ds5', 'ds6', 'ds7']}, ['ds3', 'ds6'], ['ds4', 'ds7'], [],
+         ['ds1', 'ds2', 'ds5']),
+        ('grant',  {'user1': ['ds1', 'ds2', 'ds3', 'ds4'], 'user2': ['ds1', 'ds6', 'ds7']}, ['ds3', 'ds6'], ['ds4', 'ds7'], ['user2'],
+         ['ds1', 'ds2']),
+        ('revoke', {'user1': ['ds1', 'ds2', 'ds3', 'ds4'], 'user2': ['ds5', 'ds6', 'ds7']}, ['ds3', 'ds6'], ['ds4', 'ds7'], ['user1'],
+         ['ds1', 'ds2']),
+
+        # Deleted datasets are handled as non existing ones
+        ('grant',  {'user1': ['ds1', 'ds2']}, [], [], [], ['ds2'], ['ds1']),
+        ('revoke', {'user1': ['ds1', 'ds2']}, [], [], ['user1'], ['ds1'], ['ds2']),
+
+        # Non existing users are reported. Access is still granted to them (they
+        # may log in later) unless they are skipped. Access can always be revoked
+        ('grant',  {'user1': ['ds1'], 'user2': ['ds2']}, [], [], [], ['ds1', 'ds2'], [], ['user1']),
+        ('grant',  {'user1': ['ds1'], 'user2': ['ds2']}, [], [], [], ['ds2'], [], ['user1'], True),
+        ('grant',  {'user1': ['ds1'], 'user2': ['ds2']}, [], [], [], ['ds1', 'ds2'], [], ['user1', 'user2']),
+        ('grant',  {'user1': ['ds1'], 'user2': ['ds2']}, [], [], [], [], [], ['user1', 'user2'], True),
+        ('revoke', {'user1': ['ds1'], 'user2': ['ds2']}, [], [], ['user1', 'user2'], ['ds1', 'ds2'], [], ['user1']),
+        ('revoke', {'user1': ['ds1'], 'user2': ['ds2']}, [], [], ['user1', 'user2'], ['ds1', 'ds2'], [], ['user1'], True),
+    ])
+    def test_update_allowed_users(self, method, users_info, datasets_not_found, public_datasets, allowed_users, updated_datasets,
+                                  deleted_datasets=[], unknown_users=[], skip_unknown=False):
+
+        parse_result = {'users_datasets': [{'user': user, 'datasets': users_info[user]} for user in sorted(users_info)]}
+        self.configure_mocks(parse_result)
+        actions.helpers.get_config_bool_value.side_effect = lambda name: skip_unknown and name == actions.SKIP_UNKNOWN_USERS_CONFIG_PROP
+
+        # Configure the database mocks
+        references = set(dataset_id for datasets in users_info.values() for dataset_id in datasets)
+        packages = []
+        for reference in sorted(references):
+            if reference not in datasets_not_found:
+                state = 'deleted' if reference in deleted_datasets else 'active'
+                packages.append(Package('id_%s' % reference, reference, reference not in public_datasets, state))
+
+        def _add_all(pairs):
+            return set(pair for pair in pairs if pair[1] not in allowed_users)
+
+        def _delete_all(pairs):
+            return set(pair for pair in pairs if pair[1] in allowed_users)
+
+        model = MagicMock()
+        model.State.DELETED = 'deleted'
+
+        def _query(*columns):
+            query = MagicMock()
+            if columns == (model.User.name,):
+                query.filter.return_value = [(user,) for user in users_info if user not in unknown_users]
+            else:
+                query.filter.return_value = packages
+            return query
+
+        model.Session.query.side_effect = _query
+        actions.db.AllowedUser.add_all = MagicMock(side_effect=_add_all)
+        actions.db.AllowedUser.delete_all = MagicMock(side_effect=_delete_all)
+
+        # Call the function
+        context = {'user': 'user1', 'model': model, 'auth_obj': {'id': 1}}
+        function = actions.package_acquired if method == 'grant' else actions.revoke_access
+        result = function(context, users_info)
+
+        # Calculate the list of warns. Users are only checked when access is granted
+        grant = method == 'grant'
+        if grant:
+            warns = ['User %s was not found in this instance' % user_datasets['user']
+                     for user_datasets in parse_result['users_datasets'] if user_datasets['user'] in unknown_users]
+            if skip_unknown:
+                parse_result['users_datasets'] = [user_datasets for user_datasets in parse_result['users_datasets']
+                                                  if user_datasets['user'] not in unknown_users]
+        else:
+            warns = []
+
+        for user_datasets in parse_result['users_datasets']:
+            for dataset_id in user_datasets['datasets']:
+                if dataset_id in datasets_not_found or dataset_id in deleted_datasets:
+                    warns.append('Dataset %s was not found in this instance' % dataset_id)
+                elif dataset_id in public_datasets:
+                    warns.append('Unable to upload the dataset %s: It\'s a public dataset' % dataset_id)
+
+        expected_result = {'warns': warns} if len(warns) > 0 else None
+        self.assertEquals(expected_result, result)
+
+        # All the users and all the datasets are retrieved with a single query
+        expected_queries = [call(model.User.name)] if grant else []
+        if parse_result['users_datasets']:
+            expected_queries.append(call(model.Package.id, model.Package.name, model.Package.private, model.Package.state))
+        self.assertEquals(expected_queries, model.Session.query.call_args_list)
+        self.assertEquals(0, model.Package.get.call_count)
+
+        # Check that the datasets are not updated using package_update
+        actions.plugins.toolkit.get_action('package_update').assert_not_called()
+
+        # Check that all the rows have been added or deleted at once
+        expected_pairs = []
+        for user_datasets in parse_result['users_datasets']:
+            for dataset_id in user_datasets['datasets']:
+                pair = ('id_%s' % dataset_id, user_datasets['user'])
+                if dataset_id not in datasets_not_found + public_datasets + deleted_datasets and pair not in expected_pairs:
+                    expected_pairs.append(pair)
+
+        # Check that all the rows have been added or deleted at once
+        if method == 'grant':
+            actions.db.AllowedUser.add_all.assert_called_once_with(expected_pairs)
+            self.assertEquals(0, actions.db.AllowedUser.delete_all.call_count)
+        else:
+            actions.db.AllowedUser.delete_all.assert_called_once_with(expected_pairs)
+            self.assertEquals(0, actions.db.AllowedUser.add_all.call_count)
+        model.Session.commit.assert_called_once_with()
+
+        # Check that the cache and the index of the modified datasets have been updated
+        expected_ids = ['id_%s' % dataset_id for dataset_id in updated_datasets]
+        self.assertEquals(len(expected_ids), actions.cache.invalidate_package.call_count)
+        for package_id in expected_ids:
+            actions.cache.invalidate_package.assert_any_call(package_id)
+        actions.indexing.update_index.assert_called_once_with(expected_ids)
+
+    @parameterized.expand([
+        ({'packages': ['a', 'b', 'c']},     ['id_a', 'id_b', 'id_c'], set(['id_a', 'id_c']), ['id_a', 'id_c']),
+        ({'packages': ['a']},               ['id_a'],                 set(),                  []),
+        ({'organization': 'org'},           ['id_a', 'id_b'],         set(['id_b']),          ['id_b']),
+    ])
+    def test_purge_access(self, data_dict, package_ids, with_grants, expected_purged):
+        # Configure mocks
+        model = MagicMock()
+        model.Session.query.return_value.filter.return_value = [(package_id,) for package_id in package_ids]
+        organization = model.Group.get.return_value
+        organization.is_organization = True
+        actions.db.AllowedUser.delete_by_packages.return_value = with_grants
+        context = {'model': model, 'user': 'admin'}
+
+        # Call the function
+        result = actions.purge_access(context, data_dict)
+
+        # Check the result
+        self.assertEquals({'packages': expected_purged}, result)
+        actions.plugins.toolkit.check_access.assert_called_once_with(actions.constants.PURGE_ACCESS, context, data_dict)
+
+        if 'organization' in data_dict:
+            model.Group.get.assert_called_once_with('org')
+            model.Session.query.return_value.filter.assert_called_once_with(model.Package.owner_org == organization.id)
+        else:
+            actions.sa.or_.assert_called_once_with(model.Package.id.in_.return_value, model.Package.name.in_.return_value)
+            model.Package.id.in_.assert_called_once_with(data_dict['packages'])
+            model.Package.name.in_.assert_called_once_with(data_dict['packages'])
+
+        # Grants are deleted at once and the modified datasets are reindexed
+        actions.db.AllowedUser.delete_by_packages.assert_called_once_with(package_ids)
+        model.Session.commit.assert_called_once_with()
+        self.assertEquals([call(package_id) for package_id in expected_purged],
+                          actions.cache.invalidate_package.call_args_list)
+        actions.indexing.update_index.assert_called_once_with(expected_purged)
+
+    @parameterized.expand([
+        ({},                        'message',  None),
+        ({'packages': []},          'packages', None),
+        ({'packages': 'a'},         'packages', None),
+        ({'organization': 'org'},   None,       None),
+        ({'organization': 'group'}, None,       False),
+    ])
+    def test_purge_access_invalid(self, data_dict, error_field, is_organization):
+        actions.plugins.toolkit.ValidationError = self._plugins.toolkit.ValidationError
+        actions.plugins.toolkit.ObjectNotFound = self._plugins.toolkit.ObjectNotFound
+
+        model = MagicMock()
+        if is_organization is None:
+            model.Group.get.return_value = None
+        else:
+            model.Group.get.return_value.is_organization = is_organization
+
+        if error_field:
+            with self.assertRaises(actions.plugins.toolkit.ValidationError) as cm:
+                actions.purge_access({'model': model}, data_dict)
+            self.assertIn(error_field, cm.exception.error_dict)
+        else:
+            self.assertRaises(actions.plugins.toolkit.ObjectNotFound, actions.purge_access, {'model': model}, data_dict)
+
+        self.assertEquals(0, actions.db.AllowedUser.delete_by_packages.call_count)
+
+    @parameterized.expand([
+        (True,),
+        (False,),
+    ])
+    def test_index_queue_stats(self, enabled):
+        actions.helpers.get_config_bool_value.side_effect = lambda name: enabled and name == actions.indexing.ASYNC_UPDATE_CONFIG_PROP
+        actions.indexing.get_queue.return_value.stats.return_value = {'depth': 3, 'lag': 1.5, 'spooled': 2}
+
+        # Call the function
+        context = {'user': 'admin', 'model': MagicMock()}
+        result = actions.index_queue_stats(context, {})
+
+        # The metrics of the queue are returned
+        actions.plugins.toolkit.check_access.assert_called_once_with(actions.constants.INDEX_QUEUE_STATS, context, {})
+        self.assertEquals({'enabled': enabled, 'depth': 3, 'lag': 1.5, 'spooled': 2}, result)
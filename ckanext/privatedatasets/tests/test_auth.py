@@ -46,6 +46,10 @@ class AuthTest(unittest.TestCase):
         self._db = auth.db
         auth.db = MagicMock()
 
+        self._cache = auth.cache
+        auth.cache = MagicMock()
+        auth.cache.get_request_cache.side_effect = lambda name: {}
+
     def tearDown(self):
         auth.logic_auth = self._logic_auth
         auth.request = self._request
@@ -53,6 +57,7 @@ class AuthTest(unittest.TestCase):
         auth.authz = self._authz
         auth.tk = self._tk
         auth.db = self._db
+        auth.cache = self._cache
         if hasattr(self, '_package_show'):
             auth.package_show = self._package_show
 
@@ -110,14 +115,7 @@ class AuthTest(unittest.TestCase):
         returned_package.extras = {}
 
         # Configure the database
-        db_response = []
-        if db_auth is True:
-            out = auth.db.AllowedUser()
-            out.package_id = 'package_id'
-            out.user_name = user
-            db_response.append(out)
-
-        auth.db.AllowedUser.get = MagicMock(return_value=db_response)
+        auth.db.is_allowed = MagicMock(return_value=db_auth is True)
 
         if acquire_url:
             returned_package.extras['acquire_url'] = acquire_url
@@ -153,10 +151,9 @@ class AuthTest(unittest.TestCase):
         # * the dataset has no organization OR the user does not belong to that organization AND
         # * the dataset has not been created by the user who is asking for it OR the user is not specified
         if private and state == 'active' and (not owner_org or not owner_member) and (creator_user_id != user_obj_id or user_obj_id is None):
-            # Check that the database has been initialized properly
-            auth.db.init_db.assert_called_once_with(context['model'])
+            auth.db.is_allowed.assert_called_once_with(returned_package.id, user)
         else:
-            self.assertEquals(0, auth.db.init_db.call_count)
+            self.assertEquals(0, auth.db.is_allowed.call_count)
 
         # Conditions to buy a dataset; It should be private, active and should not belong to any organization
         if authorized and state == 'active' and request_path and request_path.startswith('/dataset/') and acquire_url:
@@ -247,12 +244,7 @@ class AuthTest(unittest.TestCase):
         returned_resource.package_id = 1
 
         # Configure the database
-        db_response = []
-        if db_auth is True:
-            out = auth.db.AllowedUser()
-            out.package_id = 'package_id'
-            out.user_name = user
-            db_response.append(out)
+        auth.db.is_allowed = MagicMock(return_value=db_auth is True)
 
         # Prepare the context
         context = {'model': MagicMock()}
@@ -262,7 +254,6 @@ class AuthTest(unittest.TestCase):
             context['auth_user_obj'] = MagicMock()
             context['auth_user_obj'].id = user_obj_id
 
-        auth.db.AllowedUser.get = MagicMock(return_value=db_response)
         auth.logic_auth.get_resource_object = MagicMock(return_value=returned_resource)
         auth.logic_auth.get_package_object = MagicMock(return_value=returned_package)
         auth.authz.has_user_permission_for_group_or_org = MagicMock(return_value=owner_member)
@@ -287,11 +278,126 @@ class AuthTest(unittest.TestCase):
                 self.assertEquals(0, auth.authz.has_user_permission_for_group_or_org.call_count)
 
             if private and state == 'active' and (not owner_org or not owner_member) and (creator_user_id != user_obj_id or user_obj_id is None):
-                # Check that the database has been initialized properly
-                auth.db.init_db.assert_called_once_with(context['model'])
+                auth.db.is_allowed.assert_called_once_with(returned_package.id, user)
             else:
-                self.assertEquals(0, auth.db.init_db.call_count)
+                self.assertEquals(0, auth.db.is_allowed.call_count)
+
+    def test_can_read_resources_cached(self):
+        request_cache = {}
+        auth.cache.get_request_cache.side_effect = lambda name: request_cache
+
+        package = MagicMock()
+        package.id = 'package_id'
+        package.private = True
+        package.state = 'active'
+        package.owner_org = None
+        auth.logic_auth.get_package_object = MagicMock(return_value=package)
+        auth.db.is_allowed = MagicMock(return_value=True)
+
+        context = {'model': MagicMock(), 'user': 'test'}
+
+        # The same decision is returned for all the resources of the package
+        for _ in range(3):
+            self.assertTrue(auth.can_read_resources(context, 'package_id'))
+
+        auth.logic_auth.get_package_object.assert_called_once_with(context, {'id': 'package_id'})
+        auth.db.is_allowed.assert_called_once_with('package_id', 'test')
+        auth.cache.get_request_cache.assert_called_with(auth.RESOURCES_CACHE)
+        self.assertEquals({'package_id': {'test': True}}, request_cache)
+
+        # Other users get their own decision
+        auth.db.is_allowed.return_value = False
+        self.assertFalse(auth.can_read_resources({'model': MagicMock(), 'user': 'other'}, 'package_id'))
+
+    @parameterized.expand([
+        # Anonymous user only can read public and active packages
+        (None, None,  False, 1,    False, 'active', None,     None,  [],    True),
+        (None, None,  False, 1,    True,  'active', None,     None,  [],    False),
+        (None, None,  False, 1,    False, 'draft',  None,     None,  [],    False),
+        # The creator can always read the package
+        (2,    'test', False, 2,    True,  'active', None,     None,  [],    True),
+        (2,    'test', False, 2,    True,  'draft',  None,     None,  [],    True),
+        # Sysadmins can read everything
+        (2,    'test', True,  1,    True,  'draft',  None,     None,  [],    True),
+        # Other user (no organizations)
+        (2,    'test', False, 1,    False, 'active', None,     None,  [],    True),
+        (2,    'test', False, 1,    True,  'active', None,     None,  [],    False),
+        (2,    'test', False, 1,    True,  'draft',  None,     None,  [],    False),
+        # Other user but authorized in the list of authorized users
+        (2,    'test', False, 1,    True,  'active', None,     None,  ['0'], False),
+        (2,    'test', False, 1,    True,  'active', 'conwet', False, ['0'], False),
+        # Other user with organizations
+        (2,    'test', False, 1,    True,  'active', 'conwet', False, [],    False),
+        (2,    'test', False, 1,    True,  'active', 'conwet', True,  [],    True),
+    ])
+    def test_get_readable_packages(self, user_obj_id, user, sysadmin, creator_user_id, private, state,
+                                   owner_org, owner_member, db_allowed, authorized):
+
+        packages = []
+        for i in range(3):
+            packages.append({
+                'id': str(i),
+                'creator_user_id': creator_user_id,
+                'private': private,
+                'state': state,
+                'owner_org': owner_org
+            })
+
+        auth.db.get_allowed_packages = MagicMock(side_effect=lambda ids, user_name: set(ids) & set(db_allowed))
+        auth.authz.has_user_permission_for_group_or_org = MagicMock(return_value=owner_member)
+
+        # Prepare the context
+        context = {'model': MagicMock(), 'user': user}
+        if user_obj_id is not None:
+            context['auth_user_obj'] = MagicMock()
+            context['auth_user_obj'].id = user_obj_id
+            context['auth_user_obj'].sysadmin = sysadmin
 
+        result = auth.get_readable_packages(context, packages)
+
+        # Check the result
+        if authorized:
+            self.assertEquals(set(['0', '1', '2']), result)
+        else:
+            self.assertEquals(set(db_allowed), result)
+
+        checks_needed = not sysadmin and private and state == 'active' and creator_user_id != user_obj_id
+
+        # Permissions are checked once per organization
+        if checks_needed and owner_org:
+            auth.authz.has_user_permission_for_group_or_org.assert_called_once_with(owner_org, user, 'read')
+        else:
+            self.assertEquals(0, auth.authz.has_user_permission_for_group_or_org.call_count)
+
+        # Grants are retrieved with a single query
+        if checks_needed and not owner_member:
+            auth.db.get_allowed_packages.assert_called_once_with(['0', '1', '2'], user)
+        else:
+            self.assertEquals(0, auth.db.get_allowed_packages.call_count)
+
+    @parameterized.expand([
+        # Public datasets never show the list
+        (False, 1, 1,    False, False, False),
+        (False, 1, 1,    True,  True,  False),
+        # Users updating the list via the notification API
+        (True,  1, None, False, True,  True),
+        (None,  1, None, False, True,  True),
+        # Creator and sysadmins
+        (True,  1, 1,    False, False, True),
+        (True,  1, 2,    True,  False, True),
+        (True,  1, 2,    False, False, False),
+        (True,  1, None, False, False, False),
+    ])
+    def test_can_see_allowed_users(self, private, creator_user_id, user_obj_id, sysadmin, via_api, expected):
+        context = {}
+        if user_obj_id is not None:
+            context['auth_user_obj'] = MagicMock()
+            context['auth_user_obj'].id = user_obj_id
+            context['auth_user_obj'].sysadmin = sysadmin
+        if via_api:
+            context[auth.constants.CONTEXT_CALLBACK] = True
+
+        self.assertEquals(expected, auth.can_see_allowed_users(context, private, creator_user_id))
 
     def test_package_acquired(self):
         self.assertTrue(auth.package_acquired({}, {})['success'])
@@ -299,6 +405,14 @@ class AuthTest(unittest.TestCase):
     def test_package_deleted(self):
         self.assertTrue(auth.revoke_access({}, {})['success'])
 
+    def test_purge_access(self):
+        # Only sysadmins (who are not checked) can purge grants
+        self.assertFalse(auth.purge_access({'user': 'test'}, {})['success'])
+
+    def test_index_queue_stats(self):
+        # Only sysadmins (who are not checked) can read the metrics of the queue
+        self.assertFalse(auth.index_queue_stats({'user': 'test'}, {})['success'])
+
     @parameterized.expand([
         ({'user': 'user_1'}, {'user': 'user_1'}, True),
         ({'user': 'user_2'}, {'user': 'user_1'}, False),
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import ckanext.privatedatasets.parsers.bulk as bulk
+
+from parameterized import parameterized
+
+
+TEST_CASES = {
+    'one_user': {
+        'json': {'users_datasets': [{'user': 'test', 'datasets': ['ds1']}]},
+        'result': {'users_datasets': [{'user': 'test', 'datasets': ['ds1']}]}
+    },
+    'several_users': {
+        'json': {'users_datasets': [{'user': 'test', 'datasets': ['ds1', 'ds2']},
+                                    {'user': 'test2', 'datasets': ['ds1', 'ds3']},
+                                    {'user': 'test3', 'datasets': []}]},
+        'result': {'users_datasets': [{'user': 'test', 'datasets': ['ds1', 'ds2']},
+                                      {'user': 'test2', 'datasets': ['ds1', 'ds3']},
+                                      {'user': 'test3', 'datasets': []}]}
+    },
+    'extra_fields': {
+        'json': {'users_datasets': [{'user': 'test', 'datasets': ['ds1'], 'other': 'value'}], 'another': 1},
+        'result': {'users_datasets': [{'user': 'test', 'datasets': ['ds1']}]}
+    },
+    'no_users_datasets': {
+        'json': {'customer_name': 'test'},
+        'error': 'users_datasets not found in the request'
+    },
+    'invalid_users_datasets': {
+        'json': {'users_datasets': {'user': 'test', 'datasets': ['ds1']}},
+        'error': 'Invalid users_datasets format'
+    },
+    'invalid_user_datasets': {
+        'json': {'users_datasets': ['test']},
+        'error': 'Invalid users_datasets format'
+    },
+    'missing_datasets': {
+        'json': {'users_datasets': [{'user': 'test'}]},
+        'error': 'Invalid users_datasets format'
+    },
+    'invalid_user': {
+        'json': {'users_datasets': [{'user': 974, 'datasets': ['ds1']}]},
+        'error': 'Invalid user format'
+    },
+    'invalid_datasets': {
+        'json': {'users_datasets': [{'user': 'test', 'datasets': 'ds1'}]},
+        'error': 'Invalid datasets format for the user test'
+    },
+    'invalid_dataset': {
+        'json': {'users_datasets': [{'user': 'test', 'datasets': ['ds1', {'name': 'ds2'}]}]},
+        'error': 'Invalid datasets format for the user test'
+    },
+}
+
+
+class BulkParserTest(unittest.TestCase):
+
+    def setUp(self):
+        # Parser
+        self.parser = bulk.BulkNotificationParser()
+
+    @parameterized.expand([(case,) for case in sorted(TEST_CASES)])
+    def test_parse_notification(self, case):
+
+        # Call the function
+        if 'error' in TEST_CASES[case]:
+            with self.assertRaises(bulk.tk.ValidationError) as cm:
+                self.parser.parse_notification(TEST_CASES[case]['json'])
+            self.assertEqual(cm.exception.error_dict['message'], TEST_CASES[case]['error'])
+        else:
+            result = self.parser.parse_notification(TEST_CASES[case]['json'])
+            # Assert that the result is what we expected to be
+            self.assertEquals(TEST_CASES[case]['result'], result)
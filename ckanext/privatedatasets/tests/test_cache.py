@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import ckanext.privatedatasets.cache as cache
+
+from mock import MagicMock
+from parameterized import parameterized
+
+
+class Context(object):
+    pass
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # Create mocks
+        self._tk = cache.tk
+        cache.tk = MagicMock()
+        cache.tk.c = Context()
+
+    def tearDown(self):
+        cache.tk = self._tk
+
+    def test_get_request_cache(self):
+        entries = cache.get_request_cache('test')
+        entries['package_id'] = {'user': True}
+
+        # The same dict is returned while the request is in progress
+        self.assertIs(entries, cache.get_request_cache('test'))
+        self.assertIsNot(entries, cache.get_request_cache('other'))
+
+    def test_get_request_cache_pylons_context(self):
+        # Pylons context returns an empty string for missing attributes
+        cache.tk.c = MagicMock()
+        setattr(cache.tk.c, cache.CACHE_ATTR, '')
+
+        entries = cache.get_request_cache('test')
+        self.assertEquals({}, entries)
+        self.assertIs(entries, cache.get_request_cache('test'))
+
+    @parameterized.expand([
+        (TypeError,),
+        (RuntimeError,),
+    ])
+    def test_get_request_cache_no_request(self, exception):
+        class NoContext(object):
+            def __getattr__(self, name):
+                raise exception()
+
+        cache.tk.c = NoContext()
+
+        entries = cache.get_request_cache('test')
+        entries['package_id'] = {'user': True}
+
+        # Nothing is cached outside a request
+        self.assertEquals({}, cache.get_request_cache('test'))
+
+    def test_invalidate_package(self):
+        cache.get_request_cache('a').update({'package_id': {'user': True}, 'other_id': {'user': True}})
+        cache.get_request_cache('b').update({'package_id': {'user': False}})
+
+        cache.invalidate_package('package_id')
+
+        self.assertEquals({'other_id': {'user': True}}, cache.get_request_cache('a'))
+        self.assertEquals({}, cache.get_request_cache('b'))
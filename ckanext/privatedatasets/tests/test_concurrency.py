@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import random
+import threading
+import unittest
+
+import ckan.model as model
+
+from ckanext.privatedatasets import db
+
+
+PACKAGE_PREFIX = 'privatedatasets-concurrency-'
+PACKAGES = ['%s%d' % (PACKAGE_PREFIX, i) for i in range(5)]
+WORKERS = 10
+USERS_PER_WORKER = 20
+BATCHES = 10
+
+
+def _run_workers(function, workers_args):
+    # All the workers start at the same time. Each one uses its own session
+    # (model.Session is thread local) and returns the result of each batch
+    start = threading.Event()
+    results = [None] * len(workers_args)
+    errors = []
+
+    def _worker(i, batches):
+        start.wait()
+        try:
+            results[i] = []
+            for batch in batches:
+                results[i].append(function(batch))
+                model.Session.commit()
+        except Exception as e:
+            model.Session.rollback()
+            errors.append(e)
+        finally:
+            model.Session.remove()
+
+    threads = [threading.Thread(target=_worker, args=(i, args)) for i, args in enumerate(workers_args)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    return results, errors
+
+
+def _split(pairs, seed):
+    # Shuffles the pairs and splits them in batches, so the workers write the
+    # same rows at different moments
+    pairs = list(pairs)
+    random.Random(seed).shuffle(pairs)
+    size = len(pairs) // BATCHES + 1
+    return [pairs[i:i + size] for i in range(0, len(pairs), size)]
+
+
+class ConcurrencyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if model.meta.engine.dialect.name != 'postgresql':
+            raise unittest.SkipTest('PostgreSQL is required')
+
+        db.init_db(model)
+
+    def setUp(self):
+        self._clean()
+
+    def tearDown(self):
+        self._clean()
+
+    def _clean(self):
+        table = db.package_allowed_users_table
+        model.Session.execute(table.delete().where(table.c.package_id.like(PACKAGE_PREFIX + '%')))
+        model.Session.commit()
+
+    def _stored(self):
+        table = db.package_allowed_users_table
+        query = model.Session.query(table.c.package_id, table.c.user_name).filter(
+            table.c.package_id.like(PACKAGE_PREFIX + '%'))
+        result = set(query)
+        model.Session.commit()
+        return result
+
+    def _worker_pairs(self, worker):
+        # Each worker grants access to its own users and to the users shared by all the workers
+        users = ['worker%d-user%d' % (worker, i) for i in range(USERS_PER_WORKER)]
+        users += ['shared-user%d' % i for i in range(USERS_PER_WORKER)]
+        return [(package_id, user_name) for package_id in PACKAGES for user_name in users]
+
+    def _expected_pairs(self):
+        return set(pair for worker in range(WORKERS) for pair in self._worker_pairs(worker))
+
+    def _assert_changed_once(self, results, expected):
+        # Each row has been inserted or deleted by a single worker
+        changes = [pair for batches in results for batch in batches for pair in batch]
+        self.assertEquals(len(expected), len(changes))
+        self.assertEquals(expected, set(changes))
+
+    def test_concurrent_grants(self):
+        workers_args = [_split(self._worker_pairs(worker), worker) for worker in range(WORKERS)]
+
+        results, errors = _run_workers(db.AllowedUser.add_all, workers_args)
+
+        # No grant has been lost and no worker has failed
+        self.assertEquals([], errors)
+        self.assertEquals(self._expected_pairs(), self._stored())
+        self._assert_changed_once(results, self._expected_pairs())
+
+    def test_concurrent_grants_are_idempotent(self):
+        pairs = self._expected_pairs()
+        db.AllowedUser.add_all(pairs)
+        model.Session.commit()
+
+        workers_args = [_split(self._worker_pairs(worker), worker) for worker in range(WORKERS)]
+        results, errors = _run_workers(db.AllowedUser.add_all, workers_args)
+
+        # Stored grants are not inserted again
+        self.assertEquals([], errors)
+        self.assertEquals(pairs, self._stored())
+        self._assert_changed_once(results, set())
+
+    def test_concurrent_revokes(self):
+        pairs = self._expected_pairs()
+        db.AllowedUser.add_all(pairs)
+        model.Session.commit()
+
+        workers_args = [_split(self._worker_pairs(worker), worker) for worker in range(WORKERS)]
+        results, errors = _run_workers(db.AllowedUser.delete_all, workers_args)
+
+        # All the grants have been removed, each one by a single worker
+        self.assertEquals([], errors)
+        self.assertEquals(set(), self._stored())
+        self._assert_changed_once(results, pairs)
+
+    def test_concurrent_grants_and_revokes(self):
+        # Half of the workers revoke the grants of their own users while the
+        # other half grants access to theirs
+        revoked = set()
+        for worker in range(0, WORKERS, 2):
+            revoked.update(pair for pair in self._worker_pairs(worker) if not pair[1].startswith('shared-'))
+        db.AllowedUser.add_all(revoked)
+        model.Session.commit()
+
+        def _update(batch):
+            grants = [pair for pair in batch if pair not in revoked]
+            return db.AllowedUser.add_all(grants) | db.AllowedUser.delete_all([pair for pair in batch if pair in revoked])
+
+        workers_args = [_split(self._worker_pairs(worker), worker) for worker in range(WORKERS)]
+        results, errors = _run_workers(_update, workers_args)
+
+        self.assertEquals([], errors)
+        self.assertEquals(self._expected_pairs() - revoked, self._stored())
+        self._assert_changed_once(results, self._expected_pairs())
@@ -28,15 +28,15 @@ class ConvertersValidatorsTest(unittest.TestCase):
 
     def setUp(self):
         # Create mocks
-        self._toolkit = conv_val.toolkit
-        conv_val.toolkit = MagicMock()
-
         self._db = conv_val.db
         conv_val.db = MagicMock()
 
+        self._auth = conv_val.auth
+        conv_val.auth = MagicMock()
+
     def tearDown(self):
         conv_val.db = self._db
-        conv_val.toolkit = self._toolkit
+        conv_val.auth = self._auth
 
     @parameterized.expand([
         # When no data is present, no errors should be returned
@@ -91,8 +91,8 @@ class ConvertersValidatorsTest(unittest.TestCase):
     def test_metadata_checker(self, received_private, package_private, owner_org, metada_val, error_set):
 
         # Configure the mocks
-        package_show = MagicMock(return_value={'private': package_private, 'id': 'package_id'})
-        conv_val.toolkit.get_action = MagicMock(return_value=package_show)
+        model = MagicMock()
+        model.Package.get.return_value.private = package_private
 
         KEY = ('test',)
         errors = {}
@@ -105,13 +105,38 @@ class ConvertersValidatorsTest(unittest.TestCase):
             data[('private',)] = received_private
         data[KEY] = metada_val
 
-        conv_val.private_datasets_metadata_checker(KEY, data, errors, {})
+        conv_val.private_datasets_metadata_checker(KEY, data, errors, {'model': model})
 
         if error_set:
             self.assertEquals(1, len(errors[KEY]))
         else:
             self.assertEquals(0, len(errors[KEY]))
 
+        # The current value is only retrieved when it is needed
+        if metada_val and received_private is None:
+            model.Package.get.assert_called_once_with('package_id')
+        else:
+            self.assertEquals(0, model.Package.get.call_count)
+
+    def test_metadata_checker_private_shared(self):
+        model = MagicMock()
+        model.Package.get.return_value.private = True
+        context = {'model': model}
+
+        data = {('id',): 'package_id'}
+        errors = {}
+        for field in ['allowed_users_str', 'acquire_url', 'searchable']:
+            data[(field,)] = 'value'
+            errors[(field,)] = []
+
+        # Call the function for several fields
+        for field in ['allowed_users_str', 'acquire_url', 'searchable']:
+            conv_val.private_datasets_metadata_checker((field,), data, errors, context)
+            self.assertEquals([], errors[(field,)])
+
+        # The dataset is retrieved once for all the fields
+        model.Package.get.assert_called_once_with('package_id')
+
     @parameterized.expand([
         ('',             0, []),
         ('',             2, []),
@@ -161,25 +186,36 @@ class ConvertersValidatorsTest(unittest.TestCase):
         data = {('id',): 'package_id'}
 
         # Create the users
-        db_res = []
-        for user in users:
-            db_row = MagicMock()
-            db_row.package_id = 'package_id'
-            db_row.user_name = user
-            db_res.append(db_row)
-
-        conv_val.db.AllowedUser.get = MagicMock(return_value=db_res)
+        conv_val.db.AllowedUser.get_user_names = MagicMock(return_value=list(users))
 
         # Call the function
         context = {'model': MagicMock()}
         conv_val.get_allowed_users((key,), data, {}, context)
 
         # Check that the users are set properly
+        conv_val.db.AllowedUser.get_user_names.assert_called_once_with('package_id')
         for i, user in enumerate(users):
             self.assertEquals(user, data[(key, i)])
 
-        # Check that the table has been initialized properly
-        conv_val.db.init_db.assert_called_once_with(context['model'])
+    @parameterized.expand([
+        (True,  ['user1', 'user2']),
+        (False, []),
+    ])
+    def test_get_allowed_users_viewer(self, can_see, expected_users):
+        key = 'allowed_users'
+        data = {('id',): 'package_id', ('private',): True, ('creator_user_id',): 'creator'}
+        conv_val.auth.can_see_allowed_users.return_value = can_see
+        conv_val.db.AllowedUser.get_user_names = MagicMock(return_value=['user1', 'user2'])
+
+        # Call the function
+        context = {'model': MagicMock(), 'auth_user_obj': MagicMock()}
+        conv_val.get_allowed_users((key,), data, {}, context)
+
+        # The list is only loaded when the user can see it
+        conv_val.auth.can_see_allowed_users.assert_called_once_with(context, True, 'creator')
+        self.assertEquals(1 if can_see else 0, conv_val.db.AllowedUser.get_user_names.call_count)
+        self.assertEquals(expected_users, [data[(key, i)] for i in range(len(expected_users))])
+        self.assertNotIn((key, len(expected_users)), data)
 
     @parameterized.expand([
         (None, False),
@@ -205,7 +241,13 @@ class ConvertersValidatorsTest(unittest.TestCase):
         ('google', True),
         ('http://google', True),
         ('http://google:es', True),
-        ('www.google.es', True)
+        ('www.google.es', True),
+        # Long URLs
+        ('http://google.es/' + 'a' * 2031, False),
+        ('http://google.es/' + 'a' * 2032, True),
+        ('http://' + 'a.' * 1500 + 'es', True),
+        ('http://' + 'a.' * 1000 + '!', True),
+        ('http://[' + '1:' * 1000 + '!', True),
     ])
     def test_url_validator(self, url, expected_error):
         key = ('url',)
@@ -21,6 +21,7 @@ import unittest
 import ckanext.privatedatasets.db as db
 
 from mock import MagicMock
+from parameterized import parameterized
 
 
 class DBTest(unittest.TestCase):
@@ -33,9 +34,17 @@ class DBTest(unittest.TestCase):
         self._sa = db.sa
         db.sa = MagicMock()
 
+        self._postgresql = db.postgresql
+        db.postgresql = MagicMock()
+
+        self._write_batch_size = db.WRITE_BATCH_SIZE
+        db.WRITE_BATCH_SIZE = 2
+
     def tearDown(self):
         db.AllowedUser = None
         db.sa = self._sa
+        db.postgresql = self._postgresql
+        db.WRITE_BATCH_SIZE = self._write_batch_size
 
     def test_initdb_not_initialized(self):
 
@@ -57,3 +66,118 @@ class DBTest(unittest.TestCase):
         # Assert that table method has been called
         self.assertEquals(0, db.sa.Table.call_count)
         self.assertEquals(0, model.meta.mapper.call_count)
+
+    @parameterized.expand([
+        ([],                   ['idx_a', 'idx_b']),
+        (['idx_a'],            ['idx_b']),
+        (['idx_a', 'idx_b'],   []),
+    ])
+    def test_create_missing_indexes(self, existing, expected_created):
+        table = MagicMock()
+        table.name = 'package_allowed_users'
+        indexes = {}
+        for name in ['idx_b', 'idx_a']:
+            indexes[name] = MagicMock()
+            indexes[name].name = name
+        table.indexes = set(indexes.values())
+        db.sa.inspect.return_value.get_indexes.return_value = [{'name': name} for name in existing]
+
+        # Call the function
+        created = db.create_missing_indexes(table)
+
+        # Check that only the missing indexes have been created
+        self.assertEquals(expected_created, created)
+        db.sa.inspect.assert_called_once_with(table.bind)
+        db.sa.inspect.return_value.get_indexes.assert_called_once_with('package_allowed_users')
+        for name, index in indexes.items():
+            if name in expected_created:
+                index.create.assert_called_once_with(table.bind)
+            else:
+                self.assertEquals(0, index.create.call_count)
+
+    @parameterized.expand([
+        ([],                                                   []),
+        ([('p1', 'u2'), ('p1', 'u1'), ('p1', 'u1')],           [[('p1', 'u1'), ('p1', 'u2')]]),
+        ([('p2', 'u1'), ('p1', 'u2'), ('p1', 'u1'), ('p3', 'u1'), ('p1', 'u3')],
+         [[('p1', 'u1'), ('p1', 'u2')], [('p1', 'u3'), ('p2', 'u1')], [('p3', 'u1')]]),
+    ])
+    def test_insert_grants(self, pairs, expected_batches):
+        session = MagicMock()
+        session.execute.side_effect = lambda statement: [('p1', 'u1')]
+        table = MagicMock()
+
+        # Call the function
+        inserted = db.insert_grants(session, table, pairs)
+
+        # Rows are inserted in order with a statement for each batch
+        values = db.postgresql.insert.return_value.values
+        expected_values = [[{'package_id': package_id, 'user_name': user_name} for (package_id, user_name) in batch]
+                           for batch in expected_batches]
+        self.assertEquals(expected_values, [args[0] for (args, _) in values.call_args_list])
+        self.assertEquals(len(expected_batches), session.execute.call_count)
+        if expected_batches:
+            values.return_value.on_conflict_do_nothing.return_value.returning.assert_called_with(
+                table.c.package_id, table.c.user_name)
+        self.assertEquals(set([('p1', 'u1')]) if expected_batches else set(), inserted)
+
+    @parameterized.expand([
+        ([],                                                   []),
+        ([('p1', 'u2'), ('p1', 'u1'), ('p1', 'u1')],           [('p1', ['u1', 'u2'])]),
+        ([('p2', 'u1'), ('p1', 'u2'), ('p1', 'u1'), ('p3', 'u1'), ('p1', 'u3')],
+         [('p1', ['u1', 'u2']), ('p1', ['u3']), ('p2', ['u1']), ('p3', ['u1'])]),
+    ])
+    def test_delete_grants(self, pairs, expected_batches):
+        session = MagicMock()
+        session.execute.side_effect = lambda statement: [('p1', 'u1')]
+        table = MagicMock()
+
+        # Call the function
+        deleted = db.delete_grants(session, table, pairs)
+
+        # Rows are deleted in order with a statement for each batch of users of the same package
+        self.assertEquals([package_id for (package_id, _) in expected_batches],
+                          [args[0] for (args, _) in table.c.package_id.__eq__.call_args_list])
+        self.assertEquals([user_names for (_, user_names) in expected_batches],
+                          [args[0] for (args, _) in table.c.user_name.in_.call_args_list])
+        self.assertEquals(len(expected_batches), session.execute.call_count)
+        self.assertEquals(set([('p1', 'u1')]) if expected_batches else set(), deleted)
+
+
+class IsAllowedTest(unittest.TestCase):
+
+    def setUp(self):
+        # Create mocks
+        self._AllowedUser = db.AllowedUser
+        db.AllowedUser = MagicMock()
+
+        self._cache = db.cache
+        db.cache = MagicMock()
+        self.request_cache = {}
+        db.cache.get_request_cache.return_value = self.request_cache
+
+    def tearDown(self):
+        db.AllowedUser = self._AllowedUser
+        db.cache = self._cache
+
+    @parameterized.expand([
+        (False, False),
+        (True,  True),
+    ])
+    def test_is_allowed(self, db_response, expected_result):
+        db.AllowedUser.exists.return_value = db_response
+
+        self.assertEquals(expected_result, db.is_allowed('package_id', 'user'))
+        self.assertEquals(expected_result, db.is_allowed('package_id', 'user'))
+
+        # The database is only queried once
+        db.AllowedUser.exists.assert_called_once_with('package_id', 'user')
+        db.cache.get_request_cache.assert_called_with(db.ACL_CACHE)
+        self.assertEquals({'package_id': {'user': expected_result}}, self.request_cache)
+
+    @parameterized.expand([
+        (None,),
+        ('',),
+    ])
+    def test_is_allowed_anonymous(self, user):
+        self.assertFalse(db.is_allowed('package_id', user))
+        self.assertEquals(0, db.AllowedUser.exists.call_count)
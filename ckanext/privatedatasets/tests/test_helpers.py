@@ -49,30 +49,33 @@ class HelpersTest(unittest.TestCase):
         helpers.request = self._request
 
     @parameterized.expand([
-        (False, 'user', False),
-        (True,  'user', True),
-        (False, None,   False),
-        (True,  None,   False),
+        (False, 'user'),
+        (True,  'user'),
+        (False, None),
     ])
-    def test_is_dataset_acquired(self, db_acquired, user, acquired):
+    def test_is_dataset_acquired(self, acquired, user):
         # Configure test
         helpers.tk.c.user = user
         pkg_dict = {'id': 'package_id'}
-
-        db_response = []
-        if db_acquired is True:
-            out = helpers.db.AllowedUser()
-            out.package_id = 'package_id'
-            out.user_name = user
-            db_response.append(out)
-
-        helpers.db.AllowedUser.get = MagicMock(return_value=db_response)
+        helpers.db.is_allowed.return_value = acquired
 
         # Check the function returns the expected result
         self.assertEquals(acquired, helpers.is_dataset_acquired(pkg_dict))
+        helpers.db.is_allowed.assert_called_once_with('package_id', user)
+
+    @parameterized.expand([
+        (None,),
+        ([],),
+        ([{'id': 'a'}, {'id': 'b'}],),
+    ])
+    def test_preload_acquired_datasets(self, packages):
+        helpers.tk.c.user = 'user'
+
+        self.assertEquals('', helpers.preload_acquired_datasets(packages))
 
-        # Check that the database has been initialized properly
-        helpers.db.init_db.assert_called_once_with(helpers.model)
+        # Grants are retrieved with a single call
+        expected_ids = [package['id'] for package in packages or []]
+        helpers.db.get_allowed_packages.assert_called_once_with(expected_ids, 'user')
 
     @parameterized.expand([
         (1, 1,    True),
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import ckanext.privatedatasets.index_queue as index_queue
+
+from mock import call, MagicMock, patch
+from parameterized import parameterized
+
+
+class IndexQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        # Create mocks
+        self._tk = index_queue.tk
+        index_queue.tk = MagicMock()
+
+        self._atexit = index_queue.atexit
+        index_queue.atexit = MagicMock()
+
+        self._time = index_queue.time
+        index_queue.time = MagicMock()
+        index_queue.time.time.return_value = 100
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spool_path = os.path.join(self.tmp_dir, 'spool')
+        self.job = MagicMock()
+
+        with patch('ckanext.privatedatasets.index_queue.threading.Thread'):
+            self.queue = index_queue.IndexQueue(self.job, 5, 2, self.spool_path)
+
+    def tearDown(self):
+        index_queue.tk = self._tk
+        index_queue.atexit = self._atexit
+        index_queue.time = self._time
+        shutil.rmtree(self.tmp_dir)
+
+    @patch('ckanext.privatedatasets.index_queue.threading.Thread')
+    def test_add(self, thread):
+        self.queue.add(['a', 'b'])
+        index_queue.time.time.return_value = 110
+        self.queue.add(['b', 'c'])
+
+        # Repeated packages are coalesced and the lag is measured from the oldest one
+        index_queue.time.time.return_value = 115
+        self.assertEquals({'depth': 3, 'lag': 15, 'spooled': 0}, self.queue.stats())
+
+        # The background thread is started once
+        thread.assert_called_once_with(target=self.queue._run, name='privatedatasets-index-queue')
+        thread.return_value.start.assert_called_once_with()
+        index_queue.atexit.register.assert_called_once_with(self.queue.flush)
+
+    @parameterized.expand([
+        ([],                   []),
+        (['a'],                [['a']]),
+        (['a', 'b', 'a', 'c'], [['a', 'b'], ['c']]),
+    ])
+    @patch('ckanext.privatedatasets.index_queue.threading.Thread')
+    def test_flush(self, package_ids, expected_batches, thread):
+        for package_id in package_ids:
+            self.queue.add([package_id])
+
+        self.queue.flush()
+
+        # Packages are enqueued in batches
+        self.assertEquals([call(self.job, [batch], title='Update the search index of %d datasets' % len(batch))
+                           for batch in expected_batches], index_queue.tk.enqueue_job.call_args_list)
+        self.assertEquals({'depth': 0, 'lag': 0, 'spooled': 0}, self.queue.stats())
+
+    @patch('ckanext.privatedatasets.index_queue.threading.Thread')
+    def test_flush_spool(self, thread):
+        index_queue.tk.enqueue_job.side_effect = Exception('Redis is not available')
+
+        self.queue.add(['a', 'b', 'c'])
+        self.queue.flush()
+
+        # Packages that cannot be enqueued are spooled
+        self.assertEquals({'depth': 0, 'lag': 0, 'spooled': 3}, self.queue.stats())
+
+        # Spooled packages are sent first in the next flush
+        index_queue.tk.enqueue_job.reset_mock()
+        index_queue.tk.enqueue_job.side_effect = None
+        self.queue.add(['d', 'a'])
+        self.queue.flush()
+
+        self.assertEquals([call(self.job, [['a', 'b']], title='Update the search index of 2 datasets'),
+                           call(self.job, [['c', 'd']], title='Update the search index of 2 datasets')],
+                          index_queue.tk.enqueue_job.call_args_list)
+        self.assertEquals({'depth': 0, 'lag': 0, 'spooled': 0}, self.queue.stats())
+        self.assertEquals([], os.listdir(self.tmp_dir))
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of CKAN Private Dataset Extension.
+
+# CKAN Private Dataset Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN Private Dataset Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN Private Dataset Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import unittest
+import ckanext.privatedatasets.indexing as indexing
+
+from mock import call, MagicMock
+from parameterized import parameterized
+
+
+class IndexingTest(unittest.TestCase):
+
+    def setUp(self):
+        # Create mocks
+        self._tk = indexing.tk
+        indexing.tk = MagicMock()
+
+        self._search = indexing.search
+        indexing.search = MagicMock()
+
+        self._helpers = indexing.helpers
+        indexing.helpers = MagicMock()
+        indexing.helpers.get_config_bool_value.return_value = False
+
+        self._model = indexing.model
+        indexing.model = MagicMock()
+
+        self._db = indexing.db
+        indexing.db = MagicMock()
+
+        self._lib_plugins = indexing.lib_plugins
+        indexing.lib_plugins = MagicMock()
+
+        self._IndexQueue = indexing.IndexQueue
+        indexing.IndexQueue = MagicMock()
+        indexing._queue = None
+        indexing._unsupported_fields = None
+
+    def tearDown(self):
+        indexing.tk = self._tk
+        indexing.search = self._search
+        indexing.helpers = self._helpers
+        indexing.model = self._model
+        indexing.db = self._db
+        indexing.lib_plugins = self._lib_plugins
+        indexing.IndexQueue = self._IndexQueue
+        indexing._queue = None
+        indexing._unsupported_fields = None
+
+    def _configure_actions(self):
+        def _package_show(context, data_dict):
+            return {'id': data_dict['id'], 'revision_id': 'revision'}
+
+        actions = {'package_show': MagicMock(side_effect=_package_show),
+                   'revision_show': MagicMock(return_value={'timestamp': '7888'})}
+        indexing.tk.get_action = MagicMock(side_effect=lambda action: actions[action])
+        return actions
+
+    def _configure_schema(self, conn, fields=None, dynamic_fields=None, copy_fields=None):
+        # By default, the schema supports atomic updates
+        fields = fields if fields is not None else [{'name': 'id', 'stored': True}, {'name': 'text', 'stored': False},
+                                                    {'name': 'permission_labels', 'stored': False}]
+        dynamic_fields = dynamic_fields if dynamic_fields is not None else [{'name': 'extras_*', 'stored': True}]
+        copy_fields = copy_fields if copy_fields is not None else [{'source': 'title', 'dest': 'text'}]
+
+        responses = {'fields': {'fields': fields},
+                     'dynamicfields': {'dynamicFields': dynamic_fields},
+                     'copyfields': {'copyFields': copy_fields}}
+        conn._send_request.side_effect = lambda method, path: json.dumps(responses[path.split('/')[1].split('?')[0]])
+
+    @parameterized.expand([
+        ([],),
+        (['package_id'],),
+        (['package_id', 'other_id', 'another_id'],),
+    ])
+    def test_update_index(self, package_ids):
+        # Configure mocks
+        revision = {'timestamp': '7888'}
+
+        def _package_show(context, data_dict):
+            return {'id': data_dict['id'], 'a': '0', 'revision_id': 'revision_%s' % data_dict['id']}
+
+        package_show = MagicMock(side_effect=_package_show)
+        revision_show = MagicMock(return_value=revision.copy())
+
+        def _get_action(action):
+            if action == 'package_show':
+                return package_show
+            elif action == 'revision_show':
+                return revision_show
+
+        indexing.tk.get_action = MagicMock(side_effect=_get_action)
+
+        # Call the function
+        indexing.update_index(package_ids)
+
+        # Check that the index has been updated
+        indexer = indexing.search.PackageSearchIndex.return_value
+        self.assertEquals(len(package_ids), indexer.update_dict.call_count)
+        for package_id in package_ids:
+            package_show.assert_any_call({'model': indexing.model, 'ignore_auth': True, 'validate': False, 'use_cache': False},
+                                         {'id': package_id})
+            revision_show.assert_any_call({'ignore_auth': True}, {'id': 'revision_%s' % package_id})
+
+            expected_dict = {'id': package_id, 'a': '0', 'revision_id': 'revision_%s' % package_id,
+                             'metadata_modified': revision['timestamp']}
+            self.assertIn(call(expected_dict, defer_commit=True), indexer.update_dict.call_args_list)
+
+        # Changes are committed once
+        if package_ids:
+            indexing.search.commit.assert_called_once_with()
+        else:
+            self.assertEquals(0, indexing.search.commit.call_count)
+
+    @parameterized.expand([
+        (['package_id'],               ['package_id'],               []),
+        (['package_id', 'other_id'],   ['package_id'],               ['other_id']),
+        (['package_id', 'other_id'],   [],                           ['package_id', 'other_id']),
+    ])
+    def test_update_index_partial(self, package_ids, indexed_ids, expected_reindexed):
+        # Configure mocks
+        indexing.helpers.get_config_bool_value.side_effect = lambda name: name == indexing.PARTIAL_UPDATE_CONFIG_PROP
+        indexing.tk.config = {'ckan.site_id': 'site'}
+        actions = self._configure_actions()
+
+        def _package_get(package_id):
+            package = MagicMock()
+            package.id = package_id
+            return package
+
+        indexing.model.Package.get = MagicMock(side_effect=_package_get)
+
+        indexing.db.AllowedUser.get_user_names.return_value = ['user']
+
+        labels = indexing.lib_plugins.get_permission_labels.return_value
+        labels.get_dataset_labels.return_value = ['creator-1']
+
+        conn = indexing.search.make_connection.return_value
+        self._configure_schema(conn)
+        stored_dict = json.dumps({'id': 'package_id', 'allowed_users': ['old']})
+        conn.search.return_value = [{'id': package_id, 'index_id': 'index_%s' % package_id,
+                                     'data_dict': stored_dict, 'validated_data_dict': stored_dict}
+                                    for package_id in indexed_ids]
+
+        # Call the function
+        indexing.update_index(package_ids)
+
+        # Check that the stored documents have been requested
+        conn.search.assert_called_once_with(q='*:*', fq=['+site_id:"site"', '+id:(%s)' % ' OR '.join('"%s"' % package_id for package_id in package_ids)],
+                                            fl='id,index_id,data_dict,validated_data_dict', rows=len(package_ids))
+
+        # Check that only the ACL fields of the indexed packages have been updated
+        if indexed_ids:
+            expected_dict = json.dumps({'id': 'package_id', 'allowed_users': ['user']})
+            conn.add.assert_called_once_with([{'index_id': 'index_%s' % package_id, 'permission_labels': ['creator-1'],
+                                               'data_dict': expected_dict, 'validated_data_dict': expected_dict}
+                                              for package_id in indexed_ids],
+                                             fieldUpdates={'permission_labels': 'set', 'data_dict': 'set', 'validated_data_dict': 'set'},
+                                             commit=False)
+        else:
+            self.assertEquals(0, conn.add.call_count)
+
+        # Only the names of the allowed users are loaded
+        self.assertEquals([call(package_id) for package_id in indexed_ids],
+                          indexing.db.AllowedUser.get_user_names.call_args_list)
+        self.assertEquals(0, indexing.db.AllowedUser.get.call_count)
+
+        # Packages that are not indexed are fully reindexed
+        indexer = indexing.search.PackageSearchIndex.return_value
+        self.assertEquals(len(expected_reindexed), indexer.update_dict.call_count)
+        self.assertEquals([call({'model': indexing.model, 'ignore_auth': True, 'validate': False, 'use_cache': False}, {'id': package_id})
+                           for package_id in expected_reindexed], actions['package_show'].call_args_list)
+
+        indexing.search.commit.assert_called_once_with()
+
+        # The schema has been checked
+        self.assertEquals([], indexing._unsupported_fields)
+
+    @parameterized.expand([
+        ([{'name': 'urls', 'stored': False}],                        [],                                     [],                                  ['urls']),
+        ([{'name': 'urls', 'stored': False, 'docValues': True}],     [],                                     [],                                  []),
+        ([{'name': 'urls', 'stored': False}],                        [],                                     [{'source': 'url', 'dest': 'urls'}], []),
+        ([{'name': '_root_', 'stored': False}],                      [],                                     [],                                  []),
+        ([{'name': 'urls'}],                                         [{'name': '*', 'stored': False}],       [],                                  ['*']),
+        ([{'name': 'urls', 'stored': False}, {'name': 'id'}],        [{'name': '*', 'stored': False}],       [],                                  ['*', 'urls']),
+    ])
+    def test_update_index_partial_schema(self, fields, dynamic_fields, copy_fields, expected_unsupported):
+        # Configure mocks
+        indexing.helpers.get_config_bool_value.side_effect = lambda name: name == indexing.PARTIAL_UPDATE_CONFIG_PROP
+        indexing.tk.config = {}
+        self._configure_actions()
+        conn = indexing.search.make_connection.return_value
+        self._configure_schema(conn, fields, dynamic_fields, copy_fields)
+        conn.search.return_value = []
+
+        # Call the function twice
+        indexing.update_index(['package_id', 'other_id'])
+        indexing.update_index(['package_id', 'other_id'])
+
+        # The schema is only read once
+        self.assertEquals(3, conn._send_request.call_count)
+        self.assertEquals(expected_unsupported, indexing._unsupported_fields)
+
+        # When the schema does not support atomic updates, the packages are
+        # fully reindexed without searching their documents
+        if expected_unsupported:
+            self.assertEquals(0, conn.search.call_count)
+        else:
+            self.assertEquals(2, conn.search.call_count)
+        self.assertEquals(0, conn.add.call_count)
+        self.assertEquals(4, indexing.search.PackageSearchIndex.return_value.update_dict.call_count)
+
+    def test_update_index_partial_schema_error(self):
+        # Configure mocks
+        indexing.helpers.get_config_bool_value.side_effect = lambda name: name == indexing.PARTIAL_UPDATE_CONFIG_PROP
+        indexing.tk.config = {}
+        self._configure_actions()
+        conn = indexing.search.make_connection.return_value
+        conn._send_request.side_effect = indexing.pysolr.SolrError('error')
+
+        # Call the function
+        indexing.update_index(['package_id', 'other_id'])
+
+        # All the packages are fully reindexed and the schema will be checked again
+        self.assertEquals(0, conn.search.call_count)
+        self.assertEquals(2, indexing.search.PackageSearchIndex.return_value.update_dict.call_count)
+        self.assertIsNone(indexing._unsupported_fields)
+
+    def test_reindex_packages_not_found(self):
+        # Configure mocks
+        indexing.tk.ObjectNotFound = self._tk.ObjectNotFound
+        actions = self._configure_actions()
+        package_show = actions['package_show'].side_effect
+
+        def _package_show(context, data_dict):
+            if data_dict['id'] == 'purged_id':
+                raise indexing.tk.ObjectNotFound()
+            return package_show(context, data_dict)
+
+        actions['package_show'].side_effect = _package_show
+
+        # Call the function
+        indexing.reindex_packages(['package_id', 'purged_id', 'other_id'])
+
+        # Packages that do not exist anymore are skipped
+        indexer = indexing.search.PackageSearchIndex.return_value
+        self.assertEquals([call({'id': package_id, 'revision_id': 'revision', 'metadata_modified': '7888'}, defer_commit=True)
+                           for package_id in ['package_id', 'other_id']], indexer.update_dict.call_args_list)
+        indexing.search.commit.assert_called_once_with()
+
+    def test_update_index_partial_error(self):
+        # Configure mocks
+        indexing.helpers.get_config_bool_value.side_effect = lambda name: name == indexing.PARTIAL_UPDATE_CONFIG_PROP
+        indexing.tk.config = {}
+        self._configure_actions()
+        conn = indexing.search.make_connection.return_value
+        self._configure_schema(conn)
+        conn.search.side_effect = indexing.pysolr.SolrError('error')
+
+        # Call the function
+        indexing.update_index(['package_id', 'other_id'])
+
+        # All the packages are fully reindexed
+        indexer = indexing.search.PackageSearchIndex.return_value
+        self.assertEquals(2, indexer.update_dict.call_count)
+        indexing.search.commit.assert_called_once_with()
+
+    def test_update_index_async(self):
+        # Configure mocks
+        indexing.helpers.get_config_bool_value.side_effect = lambda name: name == indexing.ASYNC_UPDATE_CONFIG_PROP
+        indexing.tk.config = {indexing.ASYNC_INTERVAL_CONFIG_PROP: '2',
+                              indexing.ASYNC_BATCH_SIZE_CONFIG_PROP: '50',
+                              indexing.ASYNC_SPOOL_CONFIG_PROP: '/tmp/spool'}
+
+        # Call the function
+        indexing.update_index(['package_id'])
+        indexing.update_index(['package_id', 'other_id'])
+
+        # Packages are added to a single queue and not updated in the request
+        indexing.IndexQueue.assert_called_once_with(indexing.reindex_packages, 2.0, 50, '/tmp/spool')
+        queue = indexing.IndexQueue.return_value
+        self.assertEquals([call(['package_id']), call(['package_id', 'other_id'])], queue.add.call_args_list)
+        self.assertEquals(0, indexing.search.PackageSearchIndex.call_count)
+        self.assertEquals(0, indexing.search.commit.call_count)
@@ -21,7 +21,7 @@ import unittest
 import copy
 
 from flask import Blueprint
-from mock import MagicMock
+from mock import ANY, MagicMock, patch
 from parameterized import parameterized
 
 import ckanext.privatedatasets.plugin as plugin
@@ -38,8 +38,11 @@ class PluginTest(unittest.TestCase):
         self._db = plugin.db
         plugin.db = MagicMock()
 
-        self._search = plugin.search
-        plugin.search = MagicMock()
+        self._indexing = plugin.indexing
+        plugin.indexing = MagicMock()
+
+        self._cache = plugin.cache
+        plugin.cache = MagicMock()
 
         # Create the plugin
         self.privateDatasets = plugin.PrivateDatasets()
@@ -47,7 +50,8 @@ class PluginTest(unittest.TestCase):
     def tearDown(self):
         plugin.tk = self._tk
         plugin.db = self._db
-        plugin.search = self._search
+        plugin.indexing = self._indexing
+        plugin.cache = self._cache
 
     @parameterized.expand([
         (plugin.p.IDatasetForm,),
@@ -67,13 +71,16 @@ class PluginTest(unittest.TestCase):
         ('resource_show',     plugin.auth.resource_show),
         ('package_acquired',  plugin.auth.package_acquired),
         ('acquisitions_list', plugin.auth.acquisitions_list),
-        ('revoke_access',   plugin.auth.revoke_access)
+        ('revoke_access',   plugin.auth.revoke_access),
+        ('purge_access',    plugin.auth.purge_access),
+        ('index_queue_stats', plugin.auth.index_queue_stats)
     ])
     def test_auth_function(self, function_name, expected_function):
         auth_functions = self.privateDatasets.get_auth_functions()
         self.assertEquals(auth_functions[function_name], expected_function)
 
-    def test_update_config(self):
+    @patch('ckanext.privatedatasets.plugin.actions.load_parser')
+    def test_update_config(self, load_parser):
         # Call the method
         config = {'test': 1234, 'another': 'value'}
         self.privateDatasets.update_config(config)
@@ -84,6 +91,14 @@ class PluginTest(unittest.TestCase):
         else:
             plugin.tk.add_template_directory.assert_called_once_with(config, 'templates')
         plugin.tk.add_resource('fanstatic', 'privatedatasets')
+        load_parser.assert_called_once_with(config)
+
+    def test_configure(self):
+        # Call the method
+        self.privateDatasets.configure({'test': 1234})
+
+        # The allowed users table is mapped when the plugin is configured
+        plugin.db.init_db.assert_called_once_with(plugin.model)
 
     def test_get_blueprint(self):
         # Call the method
@@ -92,7 +107,9 @@ class PluginTest(unittest.TestCase):
     @parameterized.expand([
         ('package_acquired',  plugin.actions.package_acquired),
         ('acquisitions_list', plugin.actions.acquisitions_list),
-        ('revoke_access',   plugin.actions.revoke_access)
+        ('revoke_access',   plugin.actions.revoke_access),
+        ('purge_access',    plugin.actions.purge_access),
+        ('index_queue_stats', plugin.actions.index_queue_stats)
     ])
     def test_actions_function(self, function_name, expected_function):
         actions = self.privateDatasets.get_actions()
@@ -108,7 +125,8 @@ class PluginTest(unittest.TestCase):
         ('is_dataset_acquired',   plugin.helpers.is_dataset_acquired),
         ('get_allowed_users_str', plugin.helpers.get_allowed_users_str),
         ('is_owner',              plugin.helpers.is_owner),
-        ('can_read',              plugin.helpers.can_read)
+        ('can_read',              plugin.helpers.can_read),
+        ('preload_acquired_datasets', plugin.helpers.preload_acquired_datasets)
     ])
     def test_helpers_functions(self, function_name, expected_function):
         helpers_functions = self.privateDatasets.get_helpers()
@@ -177,36 +195,16 @@ class PluginTest(unittest.TestCase):
         pkg_dict = {'test': 'a', 'id': pkg_id, 'private': private, 'allowed_users': allowed_users}
         expected_pkg_dict = pkg_dict.copy()
 
-        # Configure the database mock
-        db_current_users = []
-        for user in allowed_users:
-            db_user = MagicMock()
-            db_user.package_id = pkg_id
-            db_user.user_name = user
-            db_current_users.append(db_user)
-
-        # Allowed users
-        plugin.db.AllowedUser.get = MagicMock(return_value=db_current_users)
-
         context = {'user': 'test', 'auth_user_obj': {'id': 1}, 'session': MagicMock(), 'model': MagicMock()}
         result = self.privateDatasets.after_delete(context, pkg_dict)   # Call the function
         self.assertEquals(expected_pkg_dict, result)                    # Check the result
 
-        # Assert that the get method has been called
-        plugin.db.init_db.assert_called_once_with(context['model'])
-        plugin.db.AllowedUser.get.assert_called_once_with(package_id=pkg_id)
+        # Check that all the users has been deleted with a single statement
+        plugin.db.AllowedUser.delete_by_packages.assert_called_once_with([pkg_id])
+        context['session'].commit.assert_called_once_with()
 
-        # Check that all the users has been deleted
-        for user in allowed_users:
-            found = False
-            for call in context['session'].delete.call_args_list:
-                call_user = call[0][0]
-
-                if call_user.package_id == pkg_id and call_user.user_name == user:
-                    found = True
-                    break
-
-            self.assertTrue(found)
+        # Check that cached grants have been discarded
+        plugin.cache.invalidate_package.assert_called_once_with(pkg_id)
 
     @parameterized.expand([
         (True,  1, 1,    False, True,  True, [{'id': 1}, {'id': 2}], True),
@@ -326,38 +324,8 @@ class PluginTest(unittest.TestCase):
     def _aux_test_after_create_update(self, function, new_users, current_users, users_to_add, users_to_delete):
         package_id = 'package_id'
 
-        # Configure mocks
-        revision = {'timestamp': '7888'}
-        default_dict = {'a': '0', 'b': 1, 'm': True, 'revision_id': 'revision_id_uuidv4'}
-        expected_dict = default_dict.copy()
-        expected_dict['metadata_modified'] = revision['timestamp']
-        package_show = MagicMock(return_value=default_dict.copy())
-        revision_show = MagicMock(return_value=revision.copy())
-
-        def _get_action(action):
-            if action == 'package_show':
-                return package_show
-            elif action == 'revision_show':
-                return revision_show
-
-        plugin.tk.get_action = MagicMock(side_effect=_get_action)
-
-        # Each time 'AllowedUser' is called, we must get a new instance
-        # and this is the way to get this behaviour
-        def constructor():
-            return MagicMock()
-
-        plugin.db.AllowedUser = MagicMock(side_effect=constructor)
-
         # Configure the database mock
-        db_current_users = []
-        for user in current_users:
-            db_user = MagicMock()
-            db_user.package_id = package_id
-            db_user.user_name = user
-            db_current_users.append(db_user)
-
-        plugin.db.AllowedUser.get = MagicMock(return_value=db_current_users)
+        plugin.db.AllowedUser.get_user_names.return_value = list(current_users)
 
         # Call the method
         context = {'user': 'test', 'auth_user_obj': {'id': 1}, 'session': MagicMock(), 'model': MagicMock()}
@@ -365,34 +333,25 @@ class PluginTest(unittest.TestCase):
         function(context, pkg_dict)
 
         # Check that the database has been called
-        plugin.db.init_db.assert_called_once_with(context['model'])
-        plugin.db.AllowedUser.get.assert_called_once_with(package_id=pkg_dict['id'])
-
-        def _test_calls(user_list, function):
-            self.assertEquals(len(user_list), function.call_count)
-            for user in user_list:
-                found = False
-                for call in function.call_args_list:
-                    call_user = call[0][0]
-
-                    if call_user.package_id == package_id and call_user.user_name == user:
-                        found = True
-                        break
-
-                self.assertTrue(found)
-
-        # Check that the method has deleted the appropriate users
-        _test_calls(users_to_delete, context['session'].delete)
-
-        # Check that the method has added the appropiate users
-        _test_calls(users_to_add, context['session'].add)
+        plugin.db.AllowedUser.get_user_names.assert_called_once_with(pkg_dict['id'])
 
         if len(users_to_add) == 0 and len(users_to_delete) == 0:
-            # Check that the cache has not been updated
-            self.assertEquals(0, self.privateDatasets.indexer.update_dict.call_count)
+            # Check that the database and the cache have not been updated
+            self.assertEquals(0, plugin.db.AllowedUser.delete_all.call_count)
+            self.assertEquals(0, plugin.db.AllowedUser.add_all.call_count)
+            self.assertEquals(0, context['session'].commit.call_count)
+            self.assertEquals(0, plugin.indexing.update_index.call_count)
         else:
+            # Check that the appropriate users have been deleted and added at once
+            plugin.db.AllowedUser.delete_all.assert_called_once_with([(package_id, user) for user in sorted(users_to_delete)])
+            plugin.db.AllowedUser.add_all.assert_called_once_with([(package_id, user) for user in sorted(users_to_add)])
+            context['session'].commit.assert_called_once_with()
+
             # Check that the cache has been updated
-            self.privateDatasets.indexer.update_dict.assert_called_once_with(expected_dict)
+            plugin.indexing.update_index.assert_called_once_with([package_id])
+
+        # Permissions cached during the request are always discarded
+        plugin.cache.invalidate_package.assert_called_once_with(package_id)
 
     @parameterized.expand([
         # One element
@@ -445,7 +404,8 @@ class PluginTest(unittest.TestCase):
         (3, True),
         (3, False)
     ])
-    def test_packagecontroller_after_search(self, num_seach_results, user_allowed):
+    @patch('ckanext.privatedatasets.plugin.auth.get_readable_packages')
+    def test_packagecontroller_after_search(self, num_seach_results, user_allowed, get_readable_packages):
 
         # Create the list with the 
         remaining_fields = ['other_id', 'name', 'author']
@@ -455,8 +415,9 @@ class PluginTest(unittest.TestCase):
 
         search_results = {'facets': ['facet1', 'facet2'], 'results': [], 'elements': num_seach_results}
         # Add resources
-        for _ in range(num_seach_results):
+        for i in range(num_seach_results):
             search_results['results'].append({
+                'id': 'package_%d' % i,
                 'allowed_users': ['user1', 'user2'],
                 'seearchable': True,
                 'acquire_url': 'https://upm.es',
@@ -467,11 +428,21 @@ class PluginTest(unittest.TestCase):
             })
 
         # Mocking
-        plugin.tk.check_access.side_effect = None if user_allowed else plugin.tk.NotAuthorized
+        readable_packages = set(result['id'] for result in search_results['results']) if user_allowed else set()
+        get_readable_packages.return_value = readable_packages
 
         # Call the function
         final_search_results =  self.privateDatasets.after_search(copy.deepcopy(search_results), None)
 
+        # Permissions are resolved once for all the results
+        expected_context = {
+            'model': plugin.model,
+            'session': plugin.model.Session,
+            'user': plugin.tk.c.user,
+            'auth_user_obj': plugin.tk.c.userobj
+        }
+        get_readable_packages.assert_called_once_with(expected_context, final_search_results['results'])
+
         # Assertations
         for result in final_search_results['results']:
             self.assertNotIn('allowed_users', result)
@@ -481,9 +452,80 @@ class PluginTest(unittest.TestCase):
             for remaining_field in remaining_fields:
                 self.assertIn(remaining_field, result)
 
+            if not user_allowed:
+                self.assertNotIn('resources', result)
+
         self.assertEquals(final_search_results['facets'], search_results['facets'])
         self.assertEquals(final_search_results['elements'], search_results['elements'])
 
+    @parameterized.expand([
+        # Only public and active datasets are not checked
+        ({'private': False, 'state': 'active'},                                'user', False, True,  False),
+        # The allowed users stored in the index are not taken into account
+        ({'private': True,  'state': 'active', 'allowed_users': ['user']},     'user', False, False, True),
+        ({'private': True,  'state': 'active', 'allowed_users': ['user']},     'user', True,  True,  True),
+        ({'private': True,  'state': 'active', 'allowed_users': ['user']},     None,   False, False, True),
+        ({'private': True,  'state': 'active', 'allowed_users': ['other']},    'user', True,  True,  True),
+        ({'private': True,  'state': 'active'},                                'user', False, False, True),
+        ({'private': False, 'state': 'draft'},                                 'user', False, False, True),
+    ])
+    @patch('ckanext.privatedatasets.plugin.auth.get_readable_packages')
+    def test_packagecontroller_after_search_index_permissions(self, result, user, readable, expected_readable,
+                                                              expected_checked, get_readable_packages):
+        plugin.tk.c.user = user
+        result = dict(result, id='package_id', resources=['resource1'])
+        get_readable_packages.return_value = set(['package_id']) if readable else set()
+
+        final_search_results = self.privateDatasets.after_search({'results': [result]}, None)
+
+        # Only public and active results are not checked
+        if expected_checked:
+            get_readable_packages.assert_called_once_with(ANY, [result])
+        else:
+            self.assertEquals(0, get_readable_packages.call_count)
+
+        self.assertEquals(expected_readable, 'resources' in final_search_results['results'][0])
+        self.assertNotIn('allowed_users', final_search_results['results'][0])
+
+    @parameterized.expand([
+        (False, False, []),
+        (False, True,  []),
+        (True,  False, ['granted-user-user1', 'granted-user-user2']),
+        (True,  True,  ['granted-user-user1', 'granted-user-user2']),
+    ])
+    @patch('ckanext.privatedatasets.plugin.DefaultPermissionLabels.get_dataset_labels')
+    def test_get_dataset_labels(self, private, searchable, expected_granted, get_dataset_labels):
+        get_dataset_labels.return_value = ['public']
+        dataset_obj = MagicMock()
+        dataset_obj.private = private
+        dataset_obj.searchable = searchable
+        plugin.db.AllowedUser.get_user_names.return_value = ['user1', 'user2']
+
+        labels = self.privateDatasets.get_dataset_labels(dataset_obj)
+
+        expected_labels = ['public'] + (['searchable'] if searchable else []) + expected_granted
+        self.assertEquals(expected_labels, labels)
+
+        # Grants are only retrieved for private datasets
+        if private:
+            plugin.db.AllowedUser.get_user_names.assert_called_once_with(dataset_obj.id)
+        else:
+            self.assertEquals(0, plugin.db.AllowedUser.get_user_names.call_count)
+
+    @parameterized.expand([
+        (None,   ['public', 'searchable']),
+        ('user', ['public', 'searchable', 'granted-user-user']),
+    ])
+    @patch('ckanext.privatedatasets.plugin.DefaultPermissionLabels.get_user_dataset_labels')
+    def test_get_user_dataset_labels(self, user_name, expected_labels, get_user_dataset_labels):
+        get_user_dataset_labels.return_value = ['public']
+        user_obj = None
+        if user_name:
+            user_obj = MagicMock()
+            user_obj.name = user_name
+
+        self.assertEquals(expected_labels, self.privateDatasets.get_user_dataset_labels(user_obj))
+
     @parameterized.expand([
         (True,),
         (False,)
@@ -502,6 +544,17 @@ class PluginTest(unittest.TestCase):
         else:
             self.assertEquals(result['resources'], pkg_dict_not_allowed['resources'])
 
+        # Permissions are checked only once
+        plugin.tk.check_access.assert_called_once_with('resource_show', ANY, {'id': 1})
+
+    def test_package_controller_before_view_no_resources(self):
+        pkg_dict = {'resources': []}
+
+        result = self.privateDatasets.before_view(pkg_dict)
+
+        self.assertEquals([], result['resources'])
+        self.assertEquals(0, plugin.tk.check_access.call_count)
+
     @parameterized.expand([
         (True,),
         (False,)
@@ -520,3 +573,30 @@ class PluginTest(unittest.TestCase):
         else:
             self.assertNotIn('id', result)
             self.assertNotIn('resource_name', result)
+
+    @parameterized.expand([
+        (False, True,  True),
+        (False, False, False),
+        (True,  False, True),
+    ])
+    @patch('ckanext.privatedatasets.plugin.auth.can_read_resources')
+    def test_resource_controller_before_show_package(self, sysadmin, user_allowed, expected_allowed, can_read_resources):
+
+        resource_dict = {'id': 1, 'package_id': 'package_id', 'resource_name': 'resource_test'}
+        plugin.tk.c.userobj.sysadmin = sysadmin
+        can_read_resources.return_value = user_allowed
+
+        result = self.privateDatasets.before_show(resource_dict)
+
+        if expected_allowed:
+            self.assertEquals('resource_test', result['resource_name'])
+        else:
+            self.assertEquals({}, result)
+
+        # The package decision is used instead of checking each resource
+        self.assertEquals(0, plugin.tk.check_access.call_count)
+        if sysadmin:
+            self.assertEquals(0, can_read_resources.call_count)
+        else:
+            can_read_resources.assert_called_once_with(ANY, 'package_id')
+            self.assertEquals(plugin.tk.c.userobj, can_read_resources.call_args[0][0]['auth_user_obj'])
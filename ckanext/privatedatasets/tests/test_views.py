@@ -32,10 +32,11 @@ class ViewsTest(unittest.TestCase):
         ('NotFound', 404),
         ('NotAuthorized', 403),
     ])
-    @patch.multiple("ckanext.privatedatasets.views", base=DEFAULT, toolkit=DEFAULT, model=DEFAULT, g=DEFAULT, logic=DEFAULT, _=DEFAULT)
-    def test_exceptions_loading_users(self, exception, expected_status, base, toolkit, model, g, logic, _):
+    @patch.multiple("ckanext.privatedatasets.views", base=DEFAULT, toolkit=DEFAULT, model=DEFAULT, g=DEFAULT, logic=DEFAULT, _=DEFAULT, request=DEFAULT)
+    def test_exceptions_loading_users(self, exception, expected_status, base, toolkit, model, g, logic, _, request):
 
         # Configure the mocks
+        request.params = {}
         setattr(logic, exception, ValueError)
         toolkit.get_action().side_effect = getattr(logic, exception)
         base.abort.side_effect = TypeError
@@ -56,13 +57,25 @@ class ViewsTest(unittest.TestCase):
         toolkit.get_action().assert_called_once_with(expected_context, {'user_obj': g.userobj})
         base.abort.assert_called_once_with(expected_status, ANY)
 
-    @patch.multiple("ckanext.privatedatasets.views", base=DEFAULT, toolkit=DEFAULT, model=DEFAULT, g=DEFAULT, logic=DEFAULT)
-    def test_no_error_loading_users(self, base, toolkit, model, g, logic):
+    @parameterized.expand([
+        ({},              1, 0,  5,  [],         False),
+        ({'page': '1'},   1, 0,  20, ['pkg_21'], True),
+        ({'page': '3'},   3, 40, 20, [],         False),
+        ({'page': '3'},   3, 40, 20, ['pkg_61'], True),
+        # Some datasets could not be retrieved but there are more acquired datasets
+        ({'page': '3'},   3, 40, 18, ['pkg_61'], True),
+    ])
+    @patch.multiple("ckanext.privatedatasets.views", base=DEFAULT, toolkit=DEFAULT, model=DEFAULT, g=DEFAULT, logic=DEFAULT, request=DEFAULT, db=DEFAULT)
+    def test_no_error_loading_users(self, params, page, offset, num_datasets, next_package_ids, has_next_page, base, toolkit, model, g, logic, request, db):
+
+        request.params = params
 
         # actions
         default_user = {'user_name': 'test', 'another_val': 'example value'}
         user_show = MagicMock(return_value=default_user)
-        acquisitions_list = MagicMock()
+        datasets = [{'id': i} for i in range(num_datasets)]
+        acquisitions_list = MagicMock(return_value=datasets)
+        db.AllowedUser.get_acquired_package_ids.return_value = next_package_ids
 
         toolkit.get_action = MagicMock(side_effect=lambda action: user_show if action == 'user_show' else acquisitions_list)
 
@@ -79,12 +92,39 @@ class ViewsTest(unittest.TestCase):
         }
 
         user_show.assert_called_once_with(expected_context, {'user_obj': g.userobj})
-        acquisitions_list.assert_called_with(expected_context, None)
+        acquisitions_list.assert_called_once_with(expected_context, {'limit': views.DATASETS_PER_PAGE, 'offset': offset})
+
+        # The next page is checked in the database
+        db.AllowedUser.get_acquired_package_ids.assert_called_once_with(g.user, 1, page * views.DATASETS_PER_PAGE)
 
         # Check that the render method has been called
-        base.render.assert_called_once_with('user/dashboard_acquired.html', {'user_dict': default_user, 'acquired_datasets': acquisitions_list()})
+        expected_vars = {
+            'user_dict': default_user,
+            'acquired_datasets': datasets,
+            'page': page,
+            'has_next_page': has_next_page
+        }
+        base.render.assert_called_once_with('user/dashboard_acquired.html', expected_vars)
         self.assertEqual(returned, base.render())
 
+    @parameterized.expand([
+        ('0',),
+        ('-1',),
+        ('a',),
+    ])
+    @patch.multiple("ckanext.privatedatasets.views", base=DEFAULT, toolkit=DEFAULT, request=DEFAULT, _=DEFAULT)
+    def test_invalid_page(self, page, base, toolkit, request, _):
+
+        request.params = {'page': page}
+        base.abort.side_effect = TypeError
+
+        # Call the function
+        with self.assertRaises(TypeError):
+            views.acquired_datasets()
+
+        base.abort.assert_called_once_with(400, ANY)
+        self.assertEquals(0, toolkit.get_action.call_count)
+
     @patch("ckanext.privatedatasets.views.acquired_datasets")
     def test_there_is_a_controller_for_ckan_27(self, acquired_datasets):
         controller = views.AcquiredDatasetsControllerUI()
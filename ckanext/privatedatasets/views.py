@@ -20,27 +20,45 @@
 from __future__ import absolute_import, unicode_literals
 
 from ckan import logic, model
-from ckan.common import _, g
+from ckan.common import _, g, request
 from ckan.lib import base
 from ckan.plugins import toolkit
 
-from ckanext.privatedatasets import constants
+from ckanext.privatedatasets import constants, db
+
+
+DATASETS_PER_PAGE = 20
 
 
 def acquired_datasets():
+    try:
+        page = int(request.params.get('page', 1))
+    except ValueError:
+        page = 0
+
+    if page < 1:
+        base.abort(400, _('"page" parameter must be a positive integer'))
+
     context = {'auth_user_obj': g.userobj, 'for_view': True, 'model': model, 'session': model.Session, 'user': g.user}
     data_dict = {'user_obj': g.userobj}
+    list_data_dict = {'limit': DATASETS_PER_PAGE, 'offset': (page - 1) * DATASETS_PER_PAGE}
     try:
         user_dict = toolkit.get_action('user_show')(context, data_dict)
-        acquired_datasets = toolkit.get_action(constants.ACQUISITIONS_LIST)(context, None)
+        acquired_datasets = toolkit.get_action(constants.ACQUISITIONS_LIST)(context, list_data_dict)
     except logic.NotFound:
         base.abort(404, _('User not found'))
     except logic.NotAuthorized:
         base.abort(403, _('Not authorized to see this page'))
 
+    # The next page is checked in the database, since the list of datasets may
+    # be shorter than the limit when a dataset cannot be retrieved
+    next_package_ids = db.AllowedUser.get_acquired_package_ids(g.user, 1, page * DATASETS_PER_PAGE)
+
     extra_vars = {
         'user_dict': user_dict,
         'acquired_datasets': acquired_datasets,
+        'page': page,
+        'has_next_page': len(next_package_ids) > 0,
     }
     return base.render('user/dashboard_acquired.html', extra_vars)
 
@@ -55,5 +55,8 @@ setup(
         [ckan.plugins]
         # Add plugins here, e.g.
         privatedatasets=ckanext.privatedatasets.plugin:PrivateDatasets
+
+        [paste.paster_command]
+        privatedatasets=ckanext.privatedatasets.commands:PrivateDatasetsCommand
     ''',
 )